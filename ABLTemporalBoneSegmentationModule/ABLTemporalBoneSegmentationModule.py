@@ -1,5 +1,14 @@
+import collections
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import importlib
 import inspect
+import itertools
 import json
+import logging
+import math
 import os
 import queue
 import threading
@@ -7,45 +16,60 @@ import traceback
 import re
 import shutil
 import sys
+import tempfile
+import time
+
+importStartTime = time.perf_counter()
 
 import ctk
+import numpy as np
 import qt
 import slicer
 import SimpleITK as sitk
 import sitkUtils as sitku
-import Elastix
-import urllib3
-import requests
-import slicer
 import vtk
 from slicer.ScriptedLoadableModule import *
 
-try:
-    import ablinfer
-except ModuleNotFoundError:
-    slicer.util.pip_install("ablinfer")
-
-from ablinfer.slicer import SlicerDispatchDocker, SlicerDispatchRemote
-from ablinfer.constants import DispatchStage
-from ablinfer.remote import DispatchRemote
-from ablinfer.base import DispatchException
-
-import docker
-import requests
-import SampleData
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
+## Elastix, SampleData, requests, docker and ablinfer are slow to import and only needed by some
+## actions, so they are imported where they are used rather than at Slicer startup. The time of
+## each deferred import is measured on first use, for comparison with this module's own import time.
+deferredImportSeconds = {}
+
+
+def import_deferred(name):
+    """Import a module kept out of startup, logging what its first import cost next to the time this
+    module took to import."""
+    if name not in deferredImportSeconds:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        deferredImportSeconds[name] = time.perf_counter() - start
+        logging.debug("Deferred import of %s took %.1f ms (%.1f ms for all deferred imports so far, against %.1f ms to import ABLTemporalBoneSegmentationModule)" % (
+            name, deferredImportSeconds[name]*1000, sum(deferredImportSeconds.values())*1000, moduleImportSeconds*1000))
+    return sys.modules[name]
+
+
+def import_ablinfer():
+    """Import ablinfer's dispatchers, installing the package on first use if needed."""
+    try:
+        import ablinfer
+    except ModuleNotFoundError:
+        slicer.util.pip_install("ablinfer")
+    for name in ('ablinfer.base', 'ablinfer.constants', 'ablinfer.remote', 'ablinfer.slicer'): import_deferred(name)
+    return sys.modules['ablinfer']
+
+## 'margin' is the number of extra input slices pulled on either side of a slab when streaming, so
+## that each interpolator sees the same neighbourhood it would in a full-volume resample (B-spline
+## prefiltering is global, so it gets a wider margin to let the recursive filter settle)
 supportedResampleInterpolations = [
-    {'title': 'Linear', 'value': sitk.sitkLinear},
-    {'title': 'Nearest neighbour', 'value': sitk.sitkNearestNeighbor},
-    {'title': 'B-spline', 'value': sitk.sitkBSpline},
-    {'title': 'Gaussian', 'value': sitk.sitkGaussian},
-    {'title': 'Hamming windowed sinc', 'value': sitk.sitkHammingWindowedSinc},
-    {'title': 'Blackman windowed sinc', 'value': sitk.sitkBlackmanWindowedSinc},
-    {'title': 'Cosine windowed sinc', 'value': sitk.sitkCosineWindowedSinc},
-    {'title': 'Welch windowed sinc', 'value': sitk.sitkWelchWindowedSinc},
-    {'title': 'Lanczos windowed sinc', 'value': sitk.sitkLanczosWindowedSinc}
+    {'title': 'Linear', 'value': sitk.sitkLinear, 'margin': 1},
+    {'title': 'Nearest neighbour', 'value': sitk.sitkNearestNeighbor, 'margin': 1},
+    {'title': 'B-spline', 'value': sitk.sitkBSpline, 'margin': 12},
+    {'title': 'Gaussian', 'value': sitk.sitkGaussian, 'margin': 4},
+    {'title': 'Hamming windowed sinc', 'value': sitk.sitkHammingWindowedSinc, 'margin': 4},
+    {'title': 'Blackman windowed sinc', 'value': sitk.sitkBlackmanWindowedSinc, 'margin': 4},
+    {'title': 'Cosine windowed sinc', 'value': sitk.sitkCosineWindowedSinc, 'margin': 4},
+    {'title': 'Welch windowed sinc', 'value': sitk.sitkWelchWindowedSinc, 'margin': 4},
+    {'title': 'Lanczos windowed sinc', 'value': sitk.sitkLanczosWindowedSinc, 'margin': 4}
 ]
 
 supportedResamplePresets = [
@@ -53,6 +77,16 @@ supportedResamplePresets = [
     {'title': 'X:50um,  Y:50um,  Z:50um', 'value': [50, 50, 50]}
 ]
 
+## Rigid registration tiers: a parameter file from Resources/Parameters plus the parameters overridden in it
+supportedRegistrationTiers = [
+    {'title': 'Fast (preview)', 'value': 'fast', 'file': 'Parameters_Rigid.txt', 'overrides': {
+        'NumberOfResolutions': 3, 'ImagePyramidSchedule': [8, 8, 8, 4, 4, 4, 2, 2, 2],
+        'MaximumNumberOfIterations': 100, 'NumberOfSpatialSamples': 1024, 'NumberOfHistogramBins': 16}},
+    {'title': 'Balanced', 'value': 'balanced', 'file': 'Parameters_Rigid.txt', 'overrides': {}},
+    {'title': 'Accurate', 'value': 'accurate', 'file': 'Parameters_Rigid.txt', 'overrides': {
+        'MaximumNumberOfIterations': 1000, 'NumberOfSpatialSamples': 4096}},
+]
+
 supportedSaveTypes = [
     {'title': 'NifTI (*.nii)', 'value': '.nii'},
     {'title': 'NRRD (*.nrrd)', 'value': '.nrrd'},
@@ -109,13 +143,13 @@ class InterfaceTools:
 
     @staticmethod
     def build_fiducial_tab(fiducial, click_set, click_clear):
-        table = qt.QTableWidget(1, 3)
+        table = qt.QTableWidget(1, 4)
         table.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
         table.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
         table.setFixedHeight(46)
-        table.setHorizontalHeaderLabels(["X", "Y", "Z"])
+        table.setHorizontalHeaderLabels(["X", "Y", "Z", "Error (mm)"])
         table.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
-        for i in (range(0, 3)):
+        for i in (range(0, 4)):
             item = qt.QTableWidgetItem("-")
             item.setTextAlignment(qt.Qt.AlignCenter)
             # item.setFlags(qt.Qt.ItemIsSelectable)
@@ -137,6 +171,520 @@ class InterfaceTools:
         return tab, table
 
 
+# Resample result cache
+class ResampleCache:
+    """LRU cache of resampled voxel arrays, keyed by the source voxels, geometry, spacing and interpolator.
+
+    Content hashes are memoized per node and dropped (along with every result derived from that node)
+    as soon as the node's voxels are modified, the node is removed or the scene is closed, since node
+    IDs are reused after a close. The memory budget is read from the "abltbs_resample_cache_mb" setting.
+
+    Results that must not be copied in memory (those of a streamed resample) go to a disk tier instead,
+    written straight from the output and read back memory-mapped. Its files are named by the key, so
+    they remain valid across sessions, and the least recently used ones are deleted beyond the
+    "abltbs_resample_disk_cache_mb" budget.
+    """
+    def __init__(self):
+        self.entries = collections.OrderedDict()  # key -> (array, source node ID)
+        self.usedBytes = 0
+        self.contentHashes = {}  # node ID -> (content hash, node, observer tag)
+        self.sceneTags = None
+
+    def observe_scene(self):
+        if self.sceneTags is not None: return
+        self.sceneTags = [slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.on_node_removed),
+                          slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, lambda caller, event: self.clear())]
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def on_node_removed(self, caller, event, node):
+        if node is not None and node.GetID() is not None: self.invalidate(node.GetID())
+
+    def clear(self):
+        for nodeID in list(self.contentHashes): self.invalidate(nodeID)
+        self.entries.clear()
+        self.usedBytes = 0
+
+    @staticmethod
+    def get_budget_bytes():
+        return int(slicer.app.settings().value("abltbs_resample_cache_mb") or 2048) * 1024**2
+
+    @staticmethod
+    def get_disk_budget_bytes():
+        return int(slicer.app.settings().value("abltbs_resample_disk_cache_mb") or 8192) * 1024**2
+
+    @staticmethod
+    def get_disk_dir():
+        return os.path.join(slicer.app.cachePath, 'ABLTemporalBoneSegmentation', 'resample')
+
+    def get_disk_path(self, key):
+        return os.path.join(self.get_disk_dir(), hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '.npy')
+
+    def put_disk(self, key, array):
+        path = self.get_disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ## Write under a temporary name first, so an interrupted write never leaves a valid-looking entry
+        with open(path + '.part', 'wb') as f: np.save(f, array)
+        os.replace(path + '.part', path)
+        self.prune_disk()
+
+    def prune_disk(self):
+        directory = self.get_disk_dir()
+        files = []
+        for name in os.listdir(directory):
+            if not name.endswith('.npy'): continue
+            stat = os.stat(os.path.join(directory, name))
+            files.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        files.sort()
+        total, budget = sum(size for _, size, _ in files), self.get_disk_budget_bytes()
+        for _, size, path in files:
+            if total <= budget: break
+            os.remove(path)
+            total -= size
+
+    def get_content_hash(self, node):
+        self.observe_scene()
+        nodeID = node.GetID()
+        ## A different node under a known ID means the ID was reused
+        if nodeID in self.contentHashes and self.contentHashes[nodeID][1] is not node: self.invalidate(nodeID)
+        if nodeID not in self.contentHashes:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(np.ascontiguousarray(slicer.util.arrayFromVolume(node)))
+            tag = node.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, lambda caller, event, i=nodeID: self.invalidate(i))
+            self.contentHashes[nodeID] = (h.hexdigest(), node, tag)
+        return self.contentHashes[nodeID][0]
+
+    def get_volume_key(self, node):
+        directions = vtk.vtkMatrix4x4()
+        node.GetIJKToRASDirectionMatrix(directions)
+        geometry = tuple(node.GetSpacing()) + tuple(node.GetOrigin()) + tuple(directions.GetElement(i, j) for i in range(3) for j in range(3))
+        return (self.get_content_hash(node), geometry)
+
+    def get_key(self, node, spacing, interpolation):
+        return self.get_volume_key(node) + (tuple(spacing), interpolation)
+
+    def get(self, node, spacing, interpolation):
+        key = self.get_key(node, spacing, interpolation)
+        if key not in self.entries:
+            path = self.get_disk_path(key)
+            if not os.path.exists(path): return None
+            os.utime(path)
+            return np.load(path, mmap_mode='r')
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, node, spacing, interpolation, array, copy=True):
+        """Cache a result, in memory as a copy or, without ``copy``, in the disk tier."""
+        if not copy: return self.put_disk(self.get_key(node, spacing, interpolation), array)
+        budget = self.get_budget_bytes()
+        if array.nbytes > budget: return
+        key = self.get_key(node, spacing, interpolation)
+        if key in self.entries: self.remove(key)
+        self.entries[key] = (array.copy(), node.GetID())
+        self.usedBytes += array.nbytes
+        while self.usedBytes > budget: self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        array, _ = self.entries.pop(key)
+        self.usedBytes -= array.nbytes
+
+    def invalidate(self, node_id):
+        if node_id in self.contentHashes:
+            _, node, tag = self.contentHashes.pop(node_id)
+            node.RemoveObserver(tag)
+        for key in [k for k, (_, source) in self.entries.items() if source == node_id]: self.remove(key)
+
+
+# Atlas resources
+class AtlasResources:
+    """Loads each side's atlas, fiducials and cochlea mask once per session and reuses the nodes while
+    they remain in the scene.
+
+    Atlases are downloaded once into a persistent cache ("abltbs_atlas_cache_dir", by default under
+    Slicer's cache path). Each file's SHA256 is verified once and recorded in a JSON sidecar along
+    with its size and modification time, so later sessions only need to stat it. ``preload`` fetches,
+    verifies and reads both sides on a background thread, downloading with plain HTTP since Slicer's
+    logic classes are not thread-safe; the nodes are then created from memory on the main thread and
+    the images released. ``lock`` guards ``images`` and ``nodes``.
+    """
+    checksums = {
+        "L": "594d78fdd47b9e4e78b9edfe605eebdb11cdbb0aec690c89d2d3fe9b634a389f",
+        "R": "258c1c140438134d15bca09c6289335248bb2a6dc415edd677fcf55f29e644a3",
+    }
+    url = "https://github.com/Auditory-Biophysics-Lab/temporal-bone-segmentation/releases/download/v1.0/Atlas_%s.mha"
+
+    def __init__(self):
+        self.nodes = {}  # side -> (atlas, fiducials, mask) nodes
+        self.images = {}  # side -> (atlas, mask) images read by the preload thread
+        self.preloadThread = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_resource_path(kind, filename):
+        return slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + "/Resources/" + kind + "/" + filename
+
+    @staticmethod
+    def get_cache_dir():
+        return slicer.app.settings().value("abltbs_atlas_cache_dir") or os.path.join(slicer.app.cachePath, 'ABLTemporalBoneSegmentation', 'atlases')
+
+    @staticmethod
+    def is_verified(path, checksum):
+        try:
+            with open(path + '.json') as f: record = json.load(f)
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return False
+        return record.get('sha256') == checksum and record.get('size') == stat.st_size and record.get('mtime') == stat.st_mtime
+
+    @staticmethod
+    def verify(path, checksum):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''): h.update(block)
+        if h.hexdigest() != checksum: return False
+        stat = os.stat(path)
+        with open(path + '.json', 'w') as f: json.dump({'sha256': checksum, 'size': stat.st_size, 'mtime': stat.st_mtime}, f)
+        return True
+
+    def get_atlas_file(self, side, show_progress=True, cache_dir=None):
+        """Get the path of a side's atlas in the local cache, downloading and verifying it if needed."""
+        checksum = self.checksums[side]
+        path = os.path.join(cache_dir or self.get_cache_dir(), 'Atlas_%s.mha' % side)
+        if self.is_verified(path, checksum): return path
+        if os.path.exists(path) and self.verify(path, checksum): return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not show_progress:
+            self.download(self.url % side, path, checksum)
+            return path
+        logic = import_deferred('SampleData').SampleDataLogic()
+        window = slicer.util.createProgressDialog() if show_progress else None
+
+        ## Show a progress window, per the wiki:
+        ## https://www.slicer.org/wiki/Documentation/Nightly/ScriptRepository#Load_volume_from_URL
+        def progress(msg, level=None):
+            if window is None: return
+            print("Downloading atlas... %d%%" % logic.downloadPercent)
+            if window.wasCanceled:
+                slicer.util.errorDisplay("Download canceled! This atlas file MUST be downloaded for this module to work properly.")
+                raise Exception("Download canceled!")
+            window.show()
+            window.activateWindow()
+            window.setValue(int(logic.downloadPercent))
+            window.setLabelText("Downloading atlas...")
+            slicer.app.processEvents()
+
+        try:
+            logic.logMessage = progress
+            if os.path.exists(path): os.remove(path)
+            logic.downloadFile(self.url % side, os.path.dirname(path), os.path.basename(path), "SHA256:" + checksum)
+        finally:
+            if window is not None: window.close()
+        if not self.verify(path, checksum): raise ValueError("Checksum mismatch for the downloaded atlas " + path)
+        return path
+
+    def download(self, url, path, checksum):
+        """Download a file without any Slicer logic, so that it can run off the main thread. The file only
+        appears at ``path`` once complete and verified."""
+        import urllib.request
+        partPath = path + '.part'
+        h = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(url, timeout=60) as response, open(partPath, 'wb') as f:
+                for block in iter(lambda: response.read(2**20), b''):
+                    h.update(block)
+                    f.write(block)
+            if h.hexdigest() != checksum: raise ValueError("Checksum mismatch for the downloaded atlas " + url)
+            os.replace(partPath, path)
+        finally:
+            if os.path.exists(partPath): os.remove(partPath)
+        if not self.verify(path, checksum): raise ValueError("Checksum mismatch for the downloaded atlas " + path)
+
+    def preload(self, sides=('L', 'R')):
+        """Fetch, verify and read the given sides' atlases and masks on a background thread."""
+        ## Settings are only read on the GUI thread
+        cacheDir = self.get_cache_dir()
+        def load():
+            for side in sides:
+                with self.lock:
+                    if side in self.images or side in self.nodes: continue
+                try:
+                    atlas = sitk.ReadImage(self.get_atlas_file(side, show_progress=False, cache_dir=cacheDir))
+                    mask = sitk.ReadImage(self.get_resource_path('Masks', 'CochleaRegistrationMask_%s.nrrd' % side))
+                    with self.lock: self.images[side] = (atlas, mask)
+                except Exception as e:
+                    logging.warning("Could not preload the %s atlas: %s" % (side, e))
+        self.preloadThread = threading.Thread(target=load, daemon=True)
+        self.preloadThread.start()
+
+    def get_local_image(self, side):
+        """Get a side's atlas without creating nodes or downloading: the preloaded image, the node already
+        in the scene or the verified cached file.
+
+        :return: A SimpleITK image or a volume node, or None if the atlas is not available locally.
+        """
+        with self.lock:
+            if side in self.images: return self.images[side][0]
+            node = self.nodes.get(side, (None,))[0]
+        if node is not None and slicer.mrmlScene.IsNodePresent(node): return node
+        path = os.path.join(self.get_cache_dir(), 'Atlas_%s.mha' % side)
+        if self.is_verified(path, self.checksums[side]): return sitk.ReadImage(path)
+        return None
+
+    def wait_for_preload(self, side):
+        """Wait until the preload thread has read a side or stopped, keeping the GUI responsive since it may
+        still be downloading."""
+        def waiting():
+            with self.lock: return self.preloadThread is not None and self.preloadThread.is_alive() and side not in self.images
+        if not waiting(): return
+        window = slicer.util.createProgressDialog(labelText="Loading atlas...", maximum=0)
+        try:
+            while waiting():
+                slicer.app.processEvents()
+                self.preloadThread.join(0.05)
+        finally:
+            window.close()
+
+    def get(self, side):
+        """Get a side's atlas, fiducial and mask nodes, loading only those not already in the scene."""
+        with self.lock: nodes = list(self.nodes.get(side, (None, None, None)))
+        names = ['Atlas_' + side, 'Atlas_' + side + ' Fiducials', 'CochleaRegistrationMask_' + side]
+        for i, name in enumerate(names):
+            if nodes[i] is None or not slicer.mrmlScene.IsNodePresent(nodes[i]): nodes[i] = slicer.mrmlScene.GetFirstNodeByName(name)
+        if nodes[0] is None or nodes[2] is None: self.wait_for_preload(side)
+        ## Pushing copies the images into the scene, so they are not kept twice
+        with self.lock: images = self.images.pop(side, None)
+        if nodes[0] is None:
+            if images is not None: nodes[0] = sitku.PushVolumeToSlicer(images[0], name=names[0])
+            else: nodes[0] = slicer.util.loadVolume(self.get_atlas_file(side), {'name': names[0], 'show': False})
+            nodes[0].HideFromEditorsOn()
+        if nodes[1] is None:
+            nodes[1] = slicer.util.loadMarkups(self.get_resource_path('Atlases', 'Fiducial_%s.fcsv' % side))
+            nodes[1].SetName(names[1])
+            nodes[1].SetLocked(True)
+            nodes[1].HideFromEditorsOn()
+        if nodes[2] is None:
+            if images is not None: nodes[2] = sitku.PushVolumeToSlicer(images[1], name=names[2])
+            else: nodes[2] = slicer.util.loadVolume(self.get_resource_path('Masks', 'CochleaRegistrationMask_%s.nrrd' % side), {'name': names[2], 'show': False})
+            nodes[2].HideFromEditorsOn()
+        with self.lock: self.nodes[side] = tuple(nodes)
+        return tuple(nodes)
+
+
+# Background registration
+class ElastixConvergenceMonitor:
+    """Follows the per-iteration metric values in Elastix's log to report real progress and detect plateaus.
+
+    A resolution has plateaued once the mean metric over the last ``window`` iterations improved by less
+    than ``tolerance`` (relative) on the window before it.
+
+    Every resolution is checked, but early stopping only acts on the final one: Elastix has no way to
+    be told to move on to the next resolution, and stopping the process ends the whole registration.
+    Plateaus in earlier resolutions are only reported.
+    """
+    def __init__(self, iterations_per_resolution, window=25, tolerance=1e-3, minimum_iterations=50):
+        self.iterations = iterations_per_resolution
+        self.window = window
+        self.tolerance = tolerance
+        self.minimumIterations = minimum_iterations
+        self.resolution = -1
+        self.iteration = 0
+        self.metrics = []
+        self.plateaued = []
+
+    @property
+    def final_resolution(self):
+        return self.resolution == len(self.iterations) - 1
+
+    @property
+    def progress(self):
+        """Fraction of the maximum number of iterations done so far, over all resolutions."""
+        if self.resolution < 0: return 0.0
+        done = sum(self.iterations[:self.resolution]) + min(self.iteration, self.iterations[self.resolution])
+        return done / sum(self.iterations)
+
+    def update(self, line):
+        """Parse one log line.
+
+        :return: True if the current resolution has just plateaued.
+        """
+        if line.startswith('Resolution:'):
+            self.resolution = min(int(line.split(':')[1]), len(self.iterations) - 1)
+            self.iteration = 0
+            self.metrics = []
+            return False
+        m = re.match(r'(\d+)\t(-?[\d.]+(?:e[-+]?\d+)?)\t', line)
+        if m is None or self.resolution < 0: return False
+        self.iteration = int(m.group(1)) + 1
+        self.metrics.append(float(m.group(2)))
+        if self.resolution in self.plateaued or len(self.metrics) < max(self.minimumIterations, 2*self.window): return False
+        previous = np.mean(self.metrics[-2*self.window:-self.window])
+        last = np.mean(self.metrics[-self.window:])
+        ## Mattes MI is minimized, so improvement is a decrease
+        if previous - last < self.tolerance*abs(previous):
+            self.plateaued.append(self.resolution)
+            return True
+        return False
+
+
+class ElastixWorker(threading.Thread):
+    """Runs an Elastix process off the GUI thread, forwarding its log lines through a thread-safe queue.
+
+    With a convergence ``monitor``, the process is stopped as soon as the final resolution plateaus and
+    ``stoppedEarly`` is set; the result is then in the last per-iteration transform parameter file.
+    """
+    def __init__(self, elastix, args, temp_dir, monitor=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.elastix = elastix
+        self.args = args
+        self.tempDir = temp_dir
+        self.resultDir = None if temp_dir is None else os.path.join(temp_dir, 'result-transform')
+        self.log = queue.Queue()
+        self.abortRequested = threading.Event()
+        self.process = None
+        self.returnCode = None
+        self.error = None
+        self.matrix = None
+        self.cacheKey = None
+        self.cached = False
+        self.monitor = monitor
+        self.stoppedEarly = False
+        self.finalMetric = None
+        self.peakMemory = None
+        self.movingNode = None  # the registered volume, for whoever handles the result
+
+    def run(self):
+        try:
+            self.log.put('Register volumes...')
+            self.process = self.elastix.startElastix(self.args)
+            if self.abortRequested.is_set(): self.process.kill()
+            for line in iter(self.process.stdout.readline, ''):
+                self.log.put(line.rstrip())
+                m = re.match(r'Final metric value\s*=\s*(\S+)', line)
+                if m is not None: self.finalMetric = float(m.group(1))
+                if self.monitor is not None and self.monitor.update(line.rstrip()):
+                    ## Only the final resolution can be cut short; earlier ones run their full iterations
+                    self.log.put('Metric plateaued in resolution %d at iteration %d%s' % (self.monitor.resolution, self.monitor.iteration, '' if self.monitor.final_resolution else ', continuing to the next resolution'))
+                    if self.monitor.final_resolution:
+                        self.stoppedEarly = True
+                        self.finalMetric = self.window_metric
+                        self.process.kill()
+            self.returnCode = self.wait_process()
+            if (self.returnCode == 0 or self.stoppedEarly) and not self.abortRequested.is_set(): self.log.put('Registration is completed')
+        except Exception as e:
+            self.error = e
+
+    @property
+    def window_metric(self):
+        """Mean metric over the last ``window`` iterations of the final resolution, available whether or not
+        the run was stopped early, or None without a monitor.
+        """
+        if self.monitor is None or not self.monitor.final_resolution or not self.monitor.metrics: return None
+        return float(np.mean(self.monitor.metrics[-self.monitor.window:]))
+
+    def wait_process(self):
+        """Wait for the Elastix process, recording its peak resident memory in bytes where the OS reports it."""
+        if not hasattr(os, 'wait4'): return self.process.wait()
+        _, status, usage = os.wait4(self.process.pid, 0)
+        ## ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        self.peakMemory = usage.ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+        self.process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else (-(status & 0x7f) if status & 0x7f else status >> 8)
+        return self.process.returncode
+
+    def abort(self):
+        ## Killing the process also unblocks the reading loop, so cancellation takes effect immediately
+        self.abortRequested.set()
+        if self.process is not None and self.process.poll() is None: self.process.kill()
+
+
+class ElastixMultiStartWorker(ElastixWorker):
+    """Runs several Elastix registrations of the same inputs at once and keeps the one with the lowest
+    final metric value.
+
+    A start stopped early has no final metric from Elastix, so with convergence monitors every start is
+    compared on the mean metric over its last iterations instead.
+
+    Only the first start's log is forwarded in full. Once all starts have finished, the attributes
+    read by ``finish_elastix_rigid_registration`` are those of the best start.
+    """
+    def __init__(self, workers, temp_dir):
+        ElastixWorker.__init__(self, None, None, temp_dir)
+        self.workers = workers
+        self.best = None
+        ## Progress follows the first start until the best one is known
+        self.monitor = workers[0].monitor
+
+    def run(self):
+        for worker in self.workers: worker.start()
+        finished = set()
+        while len(finished) < len(self.workers):
+            for i, worker in enumerate(self.workers):
+                while not worker.log.empty():
+                    line = worker.log.get_nowait()
+                    ## Completion is only reported once every start has finished
+                    if i == 0 and not line.startswith('Registration is completed'): self.log.put(line)
+                if not worker.is_alive() and i not in finished:
+                    finished.add(i)
+                    self.log.put('Start %d of %d finished with final metric %s, mean over its last iterations %s' % (i + 1, len(self.workers), worker.finalMetric, worker.window_metric))
+            time.sleep(0.05)
+        monitored = self.workers[0].monitor is not None
+        get_metric = (lambda w: w.window_metric) if monitored else (lambda w: w.finalMetric)
+        candidates = [w for w in self.workers if w.error is None and (w.returnCode == 0 or w.stoppedEarly) and get_metric(w) is not None]
+        if not candidates:
+            self.error = self.workers[0].error or RuntimeError("No registration start succeeded")
+            return
+        self.best = min(candidates, key=get_metric)
+        self.args, self.resultDir, self.monitor = self.best.args, self.best.resultDir, self.best.monitor
+        self.stoppedEarly, self.finalMetric, self.returnCode = self.best.stoppedEarly, self.best.finalMetric, self.best.returnCode
+        self.log.put('Using start %d with %s metric %f' % (self.workers.index(self.best) + 1, 'mean final' if monitored else 'final', get_metric(self.best)))
+        self.log.put('Registration is completed')
+
+    def abort(self):
+        self.abortRequested.set()
+        for worker in self.workers: worker.abort()
+
+
+class ElastixMemoryWorker(ElastixWorker):
+    """Runs Elastix through its Python bindings on images already in memory, skipping the temporary files.
+
+    The result is left in ``matrix`` rather than in a transform parameter file. The bindings cannot be
+    interrupted, so an abort only discards the result once the registration returns.
+
+    As the registration shares Slicer's process, ``peakMemory`` is the highest resident memory sampled
+    during the run above that before it, which misses peaks shorter than the sampling interval.
+    """
+    def __init__(self, backend, fixed_image, moving_image, fixed_mask, moving_mask, parameter_paths, threads=None):
+        ElastixWorker.__init__(self, None, None, None)
+        self.backend = backend
+        self.images = (fixed_image, moving_image, fixed_mask, moving_mask)
+        self.parameterPaths = parameter_paths
+        self.threads = threads
+
+    def run(self):
+        done = threading.Event()
+        sampler = threading.Thread(target=self.sample_memory, args=(done,), daemon=True)
+        try:
+            self.log.put('Register volumes...')
+            self.log.put('Reading images')
+            sampler.start()
+            parameters = ABLTemporalBoneSegmentationModuleLogic.run_elastix_in_memory(self.backend, *self.images, self.parameterPaths, threads=self.threads)
+            self.matrix = ABLTemporalBoneSegmentationModuleLogic.elastix_parameters_to_matrix(parameters)
+            self.returnCode = 0
+            self.log.put('Registration is completed')
+        except Exception as e:
+            self.error = e
+        finally:
+            done.set()
+            if sampler.is_alive(): sampler.join()
+            self.images = None
+
+    def sample_memory(self, done, interval=0.1):
+        baseline = ABLTemporalBoneSegmentationModuleLogic.get_resident_memory()
+        if baseline is None: return
+        peak = baseline
+        while not done.wait(interval):
+            peak = max(peak, ABLTemporalBoneSegmentationModuleLogic.get_resident_memory() or 0)
+        self.peakMemory = peak - baseline
+
+
 # User Interface Build
 class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     # Data members --------------
@@ -145,10 +693,11 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     atlasFiducialNode = None
     maskNode = None
     inputFiducialNode = None
+    fiducialTransformNode = None
     fiducialSet = []
     intermediateNode = None
     sectionsList = []
-    elastixLogic = Elastix.ElastixLogic()
+    _elastixLogic = None
     roiNode = None
 
     # UI members -------------- (in order of appearance)
@@ -157,6 +706,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     fitAllButton = None
     leftBoneCheckBox = None
     rightBoneCheckBox = None
+    sideDetectionLabel = None
     movingSelector = None
     movingSaveButton = None
     resampleInfoLabel = None
@@ -166,6 +716,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     resampleSpacingYBox = None
     resampleSpacingZBox = None
     resampleInterpolation = None
+    resampleStreamCheckBox = None
+    resampleMemoryBox = None
     resampleButton = None
     fiducialPlacer = None
     fiducialTabs = None
@@ -178,10 +730,18 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     rigidProgress = None
     rigidApplyButton = None
     rigidCancelButton = None
+    rigidForceCheckBox = None
+    rigidAutoInitButton = None
+    rigidTierBox = None
+    rigidStartsBox = None
+    rigidWorker = None
+    rigidTimer = None
 
     isCropping = False
     cropStartButton = False
     cropAcceptButton = False
+    cropResampleCheckBox = None
+    cropInfoLabel = None
     
     inferStatus = None
     inferSource = None
@@ -222,6 +782,13 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.init_export_tools()
         self.init_resample_tools()
 
+    @property
+    def elastixLogic(self):
+        ## Importing Elastix is deferred until a registration needs it
+        if self._elastixLogic is None:
+            self._elastixLogic = import_deferred('Elastix').ElastixLogic()
+        return self._elastixLogic
+
     def init_volume_tools(self):
         self.clearMarkupsCheckbox = qt.QCheckBox("Clear All Markups When Loading New Input Volume")
         self.clearMarkupsCheckbox.enabled = True
@@ -247,6 +814,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.rightBoneCheckBox = qt.QCheckBox("Right Temporal Bone")
         self.rightBoneCheckBox.checked = False
         self.rightBoneCheckBox.connect('toggled(bool)', self.click_right_bone)
+        self.sideDetectionLabel = qt.QLabel("")
         self.movingSelector = slicer.qMRMLNodeComboBox()
         self.movingSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
         self.movingSelector.setMRMLScene(slicer.mrmlScene)
@@ -273,6 +841,11 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.resampleInterpolation = qt.QComboBox()
         for i in supportedResampleInterpolations: self.resampleInterpolation.addItem(i["title"])
         self.resampleInterpolation.currentIndex = 2
+        self.resampleStreamCheckBox = qt.QCheckBox("Stream in slabs with a memory budget of")
+        self.resampleStreamCheckBox.setToolTip("Resample the volume in z-slabs so that peak memory is set by the budget rather than by the size of the volume. Recommended for large micro-CT scans.")
+        self.resampleMemoryBox = InterfaceTools.build_spin_box(64, 65536)
+        self.resampleMemoryBox.setSuffix(" MB")
+        self.resampleMemoryBox.value = 512
         self.resampleButton = qt.QPushButton("Resample Output to New Volume")
         self.resampleButton.setFixedHeight(24)
         self.resampleButton.connect('clicked(bool)', self.click_resample_volume)
@@ -315,6 +888,19 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.rigidCancelButton.connect('clicked(bool)', self.click_rigid_cancel)
         self.rigidApplyButton = qt.QPushButton("Apply\n Rigid Registration")
         self.rigidApplyButton.connect('clicked(bool)', self.click_rigid_apply)
+        self.rigidForceCheckBox = qt.QCheckBox("Force recompute (ignore cached result)")
+        self.rigidAutoInitButton = qt.QPushButton("Auto-initialize (without fiducials)")
+        self.rigidAutoInitButton.setToolTip("Coarsely align the volume to the atlas from its image moments and phase correlation. Fiducial registration remains available if this fails.")
+        self.rigidAutoInitButton.connect('clicked(bool)', self.click_rigid_auto_initialize)
+        self.rigidTierBox = qt.QComboBox()
+        for i in supportedRegistrationTiers: self.rigidTierBox.addItem(i["title"])
+        self.rigidTierBox.currentIndex = 1
+        self.rigidStartsBox = InterfaceTools.build_spin_box(1, max(1, os.cpu_count() or 1))
+        self.rigidStartsBox.setToolTip("Run this many registrations in parallel from perturbed initial alignments and keep the best. Helps when the fiducial alignment is poor.")
+        self.rigidForceCheckBox.setToolTip("Registration results are cached by input volume, transforms and parameters. Check to run Elastix again regardless.")
+        self.rigidTimer = qt.QTimer()
+        self.rigidTimer.setInterval(50)
+        self.rigidTimer.connect('timeout()', self.poll_rigid_registration)
 
     def init_crop_and_transform(self):
         self.cropStartButton = qt.QPushButton("Choose ROI")
@@ -322,6 +908,11 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.cropAcceptButton = qt.QPushButton("Finalize ROI\nand Convert to RAS")
         self.cropAcceptButton.connect('clicked(bool)', self.click_crop_accept)
         self.cropAcceptButton.visible = False
+        self.cropResampleCheckBox = qt.QCheckBox("Resample to the spacing chosen in the Spacing Resample Tools while cropping")
+        self.cropResampleCheckBox.setToolTip("Crop and resample in a single interpolation pass over only the region of interest, instead of resampling the whole volume first.")
+        self.cropInfoLabel = qt.QLabel("")
+        self.cropInfoLabel.setWordWrap(True)
+        self.cropInfoLabel.visible = False
 
     def init_infer_tools(self):
         self.inferStatus = qt.QLabel("Status:")
@@ -423,6 +1014,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         for s in self.sectionsList: self.layout.addWidget(s)
         self.layout.addStretch()
         self.update_slicer_view()
+        if slicer.app.settings().value("abltbs_preload_atlases", "true") == "true": ABLTemporalBoneSegmentationModuleLogic.atlasResources.preload()
 
     def build_volume_tools(self):
         section = InterfaceTools.build_dropdown("Volume Tools")
@@ -438,6 +1030,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         sideSelection = qt.QHBoxLayout()
         sideSelection.addWidget(self.leftBoneCheckBox)
         sideSelection.addWidget(self.rightBoneCheckBox)
+        sideSelection.addWidget(self.sideDetectionLabel)
         layout.addRow("Side Selection: ", sideSelection)
         label = qt.QLabel("A moving volume is generated from the input and displayed on the top three views. It will update as transforms are applied.")
         label.setWordWrap(True)
@@ -481,6 +1074,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         grid.addWidget(qt.QLabel("Interpolation Mode:"), 0, 0, 1, 1)
         grid.addWidget(self.resampleInterpolation, 0, 1, 1, 1)
         grid.addWidget(self.resampleButton, 0, 2, 1, 2)
+        grid.addWidget(self.resampleStreamCheckBox, 1, 0, 1, 2)
+        grid.addWidget(self.resampleMemoryBox, 1, 2, 1, 2)
 
         layout = qt.QVBoxLayout(section)
         layout.addWidget(self.resampleInfoLabel)
@@ -506,8 +1101,17 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     def build_rigid_registration(self):
         section = InterfaceTools.build_dropdown("Step 2. Rigid Registration", disabled=True)
         layout = qt.QVBoxLayout(section)
-        layout.addWidget(qt.QLabel("Parameters: Elastix Rigid Registration"))
+        row = qt.QHBoxLayout()
+        row.addWidget(qt.QLabel("Parameters: Elastix Rigid Registration"))
+        row.addWidget(self.rigidTierBox)
+        layout.addLayout(row)
         layout.addWidget(self.rigidStatus)
+        row = qt.QHBoxLayout()
+        row.addWidget(qt.QLabel("Parallel starts:"))
+        row.addWidget(self.rigidStartsBox)
+        row.addWidget(self.rigidForceCheckBox)
+        layout.addLayout(row)
+        layout.addWidget(self.rigidAutoInitButton)
         layout.addWidget(self.rigidApplyButton)
         layout.addWidget(self.rigidProgress)
         layout.addWidget(self.rigidCancelButton)
@@ -518,8 +1122,10 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         section = InterfaceTools.build_dropdown("Step 3. Finalization ROI Transform", disabled=True)
         layout = qt.QVBoxLayout(section)
         layout.addWidget(qt.QLabel("Select the region of interest and finalize the transform for inference."))
+        layout.addWidget(self.cropResampleCheckBox)
         layout.addWidget(self.cropAcceptButton)
         layout.addWidget(self.cropStartButton)
+        layout.addWidget(self.cropInfoLabel)
         layout.setMargin(10)
         return section
 
@@ -600,6 +1206,10 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def finalize_input(self):
         side_indicator = 'R' if self.rightBoneCheckBox.isChecked() else 'L'
+        ## A fiducial preview shares the previous input's voxels, so it cannot carry over to a new input
+        for node in (self.intermediateNode, self.fiducialTransformNode):
+            if node is not None: slicer.mrmlScene.RemoveNode(node)
+        self.intermediateNode = self.fiducialTransformNode = None
         # check if side has been switched
         if self.atlasNode is not None and not self.atlasNode.GetName().startswith('Atlas_' + side_indicator):
             self.atlasNode = self.atlasFiducialNode = self.inputFiducialNode = None
@@ -667,8 +1277,30 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             else: icon = qt.QIcon(path + 'check.png') if self.fiducialSet[i]['input_indices'] != [0, 0, 0] else qt.QIcon()
             self.fiducialTabs.setTabIcon(i, icon)
             for j in (range(0, 3)): self.fiducialSet[i]["table"].item(0, j).setText('%.3f' % self.fiducialSet[i]["input_indices"][j])
+            self.fiducialSet[i]["table"].item(0, 3).setText('-' if self.fiducialSet[i]["residual"] is None else '%.3f' % self.fiducialSet[i]["residual"])
         self.fiducialApplyButton.enabled = True if completed >= 3 else False
 
+    def update_fiducial_preview(self):
+        ## Re-solve the fiducial transform and preview it through a volume sharing the moving volume's
+        ## voxels; only the transform's matrix changes from one placement to the next
+        start = time.perf_counter()
+        for f in self.fiducialSet: f["residual"] = None
+        if sum(f["input_indices"] != [0, 0, 0] for f in self.fiducialSet) < 3: return
+        if self.fiducialTransformNode is None:
+            self.fiducialTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.movingSelector.currentNode().GetName() + ' Fiducial transform')
+        residuals, rms = ABLTemporalBoneSegmentationModuleLogic.update_fiducial_transform(self.fiducialTransformNode, self.atlasFiducialNode, self.inputFiducialNode)
+        for f in self.fiducialSet: f["residual"] = residuals.get(f["label"])
+        ## The input fiducials move with the preview, so that points placed on it are still stored in the
+        ## moving volume's coordinates
+        self.inputFiducialNode.SetAndObserveTransformNodeID(self.fiducialTransformNode.GetID())
+        if self.intermediateNode is None:
+            movingNode = self.movingSelector.currentNode()
+            self.intermediateNode = ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(movingNode, name=movingNode.GetName() + "_Fiducial")
+            self.intermediateNode.SetAndObserveTransformNodeID(self.fiducialTransformNode.GetID())
+            self.update_fiducial_buttons()
+            self.update_slicer_view()
+        logging.debug("Fiducial preview updated in %.2f ms (RMS error %.3f mm)" % ((time.perf_counter() - start)*1000, rms))
+
     def update_fiducial_buttons(self):
         condition = self.intermediateNode is not None
         self.fiducialHardenButton.enabled = condition
@@ -678,14 +1310,13 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         print(text)
         progress = ABLTemporalBoneSegmentationModuleLogic.process_rigid_progress(text)
         self.rigidStatus.text = 'Status: ' + ((text[:60] + '..') if len(text) > 60 else text)
-        if progress is not None: self.rigidProgress.value = progress
+        if progress is not None: self.rigidProgress.value = max(self.rigidProgress.value, progress)
         if progress == 100:
             self.rigidProgress.visible = False
             self.rigidCancelButton.visible = False
             p = qt.QPalette()
             p.setColor(qt.QPalette.WindowText, qt.Qt.green)
             self.rigidStatus.setPalette(p)
-        slicer.app.processEvents()  # force update
 
     def update_crop_buttons(self):
         self.cropStartButton.visible = not self.isCropping
@@ -696,11 +1327,25 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.update_sections_enabled(validity)
         if not validity and self.inputSelector.currentNode() is None: return
         # check for auto side selection
+        self.sideDetectionLabel.text = ""
         s = re.search(r"\d+\w_", self.inputSelector.currentNode().GetName())
-        if s is not None:
-            s = s.group(0)[-2]
-            if s == 'R': self.click_right_bone(force=True)
-            elif s == 'L': self.click_left_bone(force=True)
+        if s is not None: s = s.group(0)[-2]
+        if s not in ('L', 'R'):
+            ## Fall back to comparing the image with both atlases
+            try:
+                detection = ABLTemporalBoneSegmentationModuleLogic.detect_side(self.inputSelector.currentNode())
+                if detection is None:
+                    logging.info("Skipping side detection until the atlases are available locally")
+                    s = None
+                else:
+                    s, confidence, _ = detection
+                    self.sideDetectionLabel.text = "Detected: %s (confidence %.2f)" % ('Left' if s == 'L' else 'Right', confidence)
+                    if confidence < ABLTemporalBoneSegmentationModuleLogic.sideDetectionMinimumConfidence: s = None
+            except Exception as e:
+                logging.warning("Side detection failed: " + str(e))
+                s = None
+        if s == 'R': self.click_right_bone(force=True)
+        elif s == 'L': self.click_left_bone(force=True)
         self.initialize_moving_volume()
         self.check_input_complete()
 
@@ -727,12 +1372,15 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     def click_save_moving(self):
         ABLTemporalBoneSegmentationModuleLogic.open_save_node_dialog(self.movingSelector.currentNode())
 
+    def get_resample_spacing(self):
+        if self.resampleTabBox.currentIndex == 0: spacing = supportedResamplePresets[self.resamplePresetBox.currentIndex]['value']
+        else: spacing = [self.resampleSpacingXBox.value, self.resampleSpacingYBox.value, self.resampleSpacingZBox.value]
+        return [float(i)/1000 for i in spacing]
+
     def click_resample_volume(self):
         def function():
-            if self.resampleTabBox.currentIndex == 0: spacing = supportedResamplePresets[self.resamplePresetBox.currentIndex]['value']
-            else: spacing = [self.resampleSpacingXBox.value, self.resampleSpacingYBox.value, self.resampleSpacingZBox.value]
-            spacing = [float(i)/1000 for i in spacing]
-            return ABLTemporalBoneSegmentationModuleLogic().pull_node_resample_push(self.movingSelector.currentNode(), spacing, supportedResampleInterpolations[self.resampleInterpolation.currentIndex]['value'])
+            budget = self.resampleMemoryBox.value if self.resampleStreamCheckBox.isChecked() else None
+            return ABLTemporalBoneSegmentationModuleLogic().pull_node_resample_push(self.movingSelector.currentNode(), self.get_resample_spacing(), supportedResampleInterpolations[self.resampleInterpolation.currentIndex]['value'], memory_budget_mb=budget)
         self.process_transform(function, set_moving_volume=True)
 
     def click_fiducial_tab(self, index):
@@ -755,6 +1403,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                 self.inputFiducialNode.RemoveMarkup(i)
                 break
         fiducial["input_indices"] = [0, 0, 0]
+        self.update_fiducial_preview()
         self.update_fiducial_table()
 
     def click_fiducial_placement(self, placing):
@@ -766,22 +1415,27 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             # self.inputFiducialNode.GetNthDisplayNode(nodeIndex).SetColor(0, 1, 0)
             self.inputFiducialNode.SetNthFiducialLabel(nodeIndex, fiducial["label"])
             self.inputFiducialNode.GetNthFiducialPosition(nodeIndex, fiducial["input_indices"])
+            self.update_fiducial_preview()
         self.update_fiducial_table()
 
     def click_fiducial_apply(self):
         def function():
+            ## The fiducial result is a reference sharing the moving volume's voxels under the fiducial
+            ## transform, so repeated apply/revert cycles never copy image data
+            movingNode = self.movingSelector.currentNode()
             if self.intermediateNode is None:
-                self.intermediateNode = slicer.vtkMRMLScalarVolumeNode()
-                slicer.mrmlScene.AddNode(self.intermediateNode)
-            self.intermediateNode.Copy(self.inputSelector.currentNode())
-            self.intermediateNode.SetName(self.movingSelector.currentNode().GetName() + "_Fiducial")
-            self.intermediateNode = ABLTemporalBoneSegmentationModuleLogic().apply_fiducial_registration(self.intermediateNode, self.atlasFiducialNode, self.inputFiducialNode)
+                self.intermediateNode = ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(movingNode, name=movingNode.GetName() + "_Fiducial")
+            self.intermediateNode, _, _ = ABLTemporalBoneSegmentationModuleLogic().apply_fiducial_registration(self.intermediateNode, self.atlasFiducialNode, self.inputFiducialNode, transform_node=self.fiducialTransformNode)
+            self.fiducialTransformNode = self.intermediateNode.GetParentTransformNode()
+            self.inputFiducialNode.SetAndObserveTransformNodeID(self.fiducialTransformNode.GetID())
             self.update_fiducial_buttons()
         self.process_transform(function, corresponding_button=self.fiducialApplyButton)
 
     def click_fiducial_revert(self):
+        self.inputFiducialNode.SetAndObserveTransformNodeID(None)
+        if self.fiducialTransformNode is not None: slicer.mrmlScene.RemoveNode(self.fiducialTransformNode)
         slicer.mrmlScene.RemoveNode(self.intermediateNode)
-        self.intermediateNode = None
+        self.intermediateNode = self.fiducialTransformNode = None
         self.update_fiducial_buttons()
         self.update_slicer_view()
 
@@ -790,33 +1444,90 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def click_fiducial_harden(self):
         def function():
-            output = ABLTemporalBoneSegmentationModuleLogic().harden_fiducial_registration(self.intermediateNode)
-            self.intermediateNode = None
+            self.inputFiducialNode.SetAndObserveTransformNodeID(None)
+            output = ABLTemporalBoneSegmentationModuleLogic().harden_fiducial_registration(self.intermediateNode, self.movingSelector.currentNode())
+            ## The placed fiducials were in the volume's old frame; the next preview starts over
+            self.intermediateNode = self.fiducialTransformNode = None
+            self.inputFiducialNode.RemoveAllMarkups()
+            for f in self.fiducialSet: f["input_indices"], f["residual"] = [0, 0, 0], None
+            self.update_fiducial_table()
             self.update_fiducial_buttons()
             return output
         self.process_transform(function, set_moving_volume=True)
 
     def click_rigid_apply(self):
+        p = qt.QPalette()
+        p.setColor(qt.QPalette.WindowText, qt.Qt.gray)
+        self.rigidStatus.setPalette(p)
+        self.rigidProgress.value = 0
+        self.rigidProgress.visible = True
+        self.rigidCancelButton.visible = True
+        self.rigidApplyButton.visible = False
+        try:
+            self.rigidWorker = ABLTemporalBoneSegmentationModuleLogic.start_elastix_rigid_registration(elastix=self.elastixLogic,
+                                                                                                      atlas_node=self.atlasNode,
+                                                                                                      moving_node=self.movingSelector.currentNode(),
+                                                                                                      mask_node=self.maskNode,
+                                                                                                      parameter_filenames=(ABLTemporalBoneSegmentationModuleLogic.get_registration_tier_parameter_file(supportedRegistrationTiers[self.rigidTierBox.currentIndex]["value"]),),
+                                                                                                      use_cache=not self.rigidForceCheckBox.checked,
+                                                                                                      starts=self.rigidStartsBox.value)
+            ## The result goes to the volume that was registered, whatever is selected by the time it finishes
+            self.rigidWorker.movingNode = self.movingSelector.currentNode()
+        except Exception as e:
+            self.update_rigid_progress(f"Error: {e}")
+            traceback.print_exc()
+            self.rigidApplyButton.visible = True
+            self.rigidCancelButton.visible = False
+            return
+        self.rigidTimer.start()
+
+    def click_rigid_auto_initialize(self):
         def transform():
-            p = qt.QPalette()
-            p.setColor(qt.QPalette.WindowText, qt.Qt.gray)
-            self.rigidStatus.setPalette(p)
-            self.rigidProgress.value = 0
-            self.rigidProgress.visible = True
-            self.rigidCancelButton.visible = True
-            self.rigidApplyButton.visible = False
-            return ABLTemporalBoneSegmentationModuleLogic().apply_elastix_rigid_registration(elastix=self.elastixLogic,
-                                                                                        atlas_node=self.atlasNode,
-                                                                                        moving_node=self.movingSelector.currentNode(),
-                                                                                        mask_node=self.maskNode,
-                                                                                        log_callback=self.update_rigid_progress)
-        self.process_transform(transform, corresponding_button=self.rigidApplyButton, set_moving_volume=True)
+            movingNode = self.movingSelector.currentNode()
+            _, score = ABLTemporalBoneSegmentationModuleLogic.apply_coarse_alignment(self.atlasNode, movingNode)
+            self.update_rigid_progress("Coarse alignment applied (NCC %.2f)" % score)
+            return movingNode
+        self.process_transform(transform, corresponding_button=self.rigidAutoInitButton, set_moving_volume=True)
+
+    def poll_rigid_registration(self):
+        ## Drain the worker's log on the GUI thread; the registration itself never blocks it
+        worker = self.rigidWorker
+        finished = not worker.is_alive()
+        while not worker.log.empty(): self.update_rigid_progress(worker.log.get_nowait())
+        if worker.monitor is not None and worker.monitor.resolution >= 0:
+            ## Iterations between reading the images (7%) and the final transform (85%)
+            self.rigidProgress.value = max(self.rigidProgress.value, 7 + int(78*worker.monitor.progress))
+        if not finished: return
+        self.rigidTimer.stop()
+        self.rigidWorker = None
+        try:
+            ## The rigid transform is added to the moving volume's transform chain; voxels are only
+            ## resampled once, when the ROI is finalized
+            movingNode = worker.movingNode
+            transformNode = ABLTemporalBoneSegmentationModuleLogic.finish_elastix_rigid_registration(self.elastixLogic, worker, movingNode.GetName())
+            ABLTemporalBoneSegmentationModuleLogic.append_transform(movingNode, transformNode)
+            if worker.cached:
+                self.rigidStatus.text = "Status: Reused cached result (check Force recompute to rerun)"
+                p = qt.QPalette()
+                p.setColor(qt.QPalette.WindowText, qt.Qt.blue)
+                self.rigidStatus.setPalette(p)
+        except Exception as e:
+            self.update_rigid_progress(f"Error: {e}")
+            traceback.print_exc()
+        finally:
+            self.rigidProgress.visible = False
+            self.rigidCancelButton.visible = False
+            self.rigidApplyButton.enabled = self.rigidApplyButton.visible = True
+            self.update_slicer_view()
 
     def click_rigid_cancel(self):
         self.rigidProgress.value = 0
         self.rigidProgress.visible = False
         self.rigidCancelButton.visible = False
-        ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.elastixLogic)
+        ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.elastixLogic, self.rigidWorker)
+        if isinstance(self.rigidWorker, ElastixMemoryWorker) and self.rigidWorker.is_alive():
+            ## The Python bindings cannot be interrupted; the result is discarded once they return
+            self.rigidStatus.text = "Status: Cancelling... (in-memory registration stops when it finishes; set abltbs_elastix_backend to \"disk\" for immediate cancel)"
 
     def click_crop_start(self):
         # cropParams = slicer.vtkMRMLCropVolumeParametersNode()
@@ -832,6 +1543,26 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def click_crop_accept(self):
         def transform():
+            ## The moving volume's whole transform chain (fiducial, rigid) is applied here, together with
+            ## the crop, in a single interpolation pass
+            movingNode = self.movingSelector.currentNode()
+            if self.cropResampleCheckBox.isChecked():
+                spacing = self.get_resample_spacing()
+                interpolation = supportedResampleInterpolations[self.resampleInterpolation.currentIndex]['value']
+            else:
+                spacing = movingNode.GetSpacing()
+                interpolation = sitk.sitkLinear
+            transformNode = movingNode.GetParentTransformNode()
+            if transformNode is None or transformNode.IsTransformToWorldLinear():
+                outputVolumeNode, report = ABLTemporalBoneSegmentationModuleLogic.crop_and_resample(movingNode, self.roiNode, spacing, interpolation)
+                self.cropInfoLabel.text = "Transformed, cropped and resampled in one pass: interpolated %d voxels, %d fewer than resampling then cropping (about %.1f s saved)." % (report['voxels'], report['voxels_saved'], report['seconds_saved'])
+                self.cropInfoLabel.visible = True
+                slicer.mrmlScene.RemoveNode(self.roiNode)
+                self.roiNode = None
+                return outputVolumeNode
+            ## Only a linear transform can be folded into the geometry, so CropVolume handles the others
+            logging.info(movingNode.GetName() + " is under a non-linear transform, cropping with Crop Volume instead of in one pass")
+
             # copy input
             outputVolumeNode = slicer.vtkMRMLScalarVolumeNode()
             outputVolumeNode.Copy(self.movingSelector.currentNode())
@@ -864,6 +1595,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.inferDockerWidget.visible = not state
 
     def _infer_progress(self, sec, f1, f2, s):
+        DispatchStage = import_ablinfer().constants.DispatchStage
         sec_map = {
             DispatchStage.Initial: (0, 5),
             DispatchStage.Validate: (5, 5),
@@ -893,7 +1625,14 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
         slicer.app.processEvents()
 
+    def harden_moving_transforms(self):
+        ## The fiducial and rigid transforms stay pending until the crop; anything that reads the voxels
+        ## with their geometry needs them applied first. They are linear, so only the geometry changes.
+        node = self.movingSelector.currentNode()
+        if node is not None and node.GetParentTransformNode() is not None: node.HardenTransform()
+
     def click_infer_apply(self):
+        self.harden_moving_transforms()
         inp = self.movingSelector.currentNode()
 
         remote = bool(self.inferSource.checked)
@@ -907,6 +1646,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay("Unable to load inference model:\n" + ''.join(traceback.format_exc()))
             return
 
+        ablinfer = import_ablinfer()
+
         ## Now assemble the configuration
         config = {
             "tmp_path": os.path.join(os.path.expanduser("~"), ".ablinfer")
@@ -930,7 +1671,9 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                 return
             
             ## Setup the session
-            s = requests.Session()
+            urllib3 = import_deferred('urllib3')
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            s = import_deferred('requests').Session()
             s.verify = False
             if username:
                 s.auth = (username, password)
@@ -940,20 +1683,20 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             config["base_url"] = host
             config["session"] = s
 
-            dispatch = SlicerDispatchRemote
+            dispatch = ablinfer.slicer.SlicerDispatchRemote
             is_docker = False
 
             ## Store the updated parameters
             settings.setValue("ablinfer_server_host", host)
         else: ## Local docker instance
-            docker = self.inferDockerHost.text.strip()
+            dockerHost = self.inferDockerHost.text.strip()
             is_docker = True
             
-            if docker:
-                config["docker"] = {"base_url": docker}
+            if dockerHost:
+                config["docker"] = {"base_url": dockerHost}
 
-            dispatch = SlicerDispatchDocker
-            settings.setValue("ablinfer_docker_host", docker)
+            dispatch = ablinfer.slicer.SlicerDispatchDocker
+            settings.setValue("ablinfer_docker_host", dockerHost)
         
         good_volume = bool(self.inferGoodVolume.isChecked())
         model_config = {
@@ -998,6 +1741,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                 get_model=True,
             )
         except Exception as e:
+            import docker
+            import requests
             traceback.print_exc()
             formetted = traceback.format_exc()
             if isinstance(e, docker.errors.ImageNotFound):
@@ -1009,14 +1754,14 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                     slicer.util.errorDisplay("Error communicating with the Docker daemon: %s.\nThis usually means that either Docker isn't running, is running in an unusual spot (which you must set in the \"Docker Host\" configuration, or you don't have permission to access it." % repr(e))
                 else:
                     slicer.util.errorDisplay("Error with remote connection: %s.\nThis usually means that something is wrong with the remote server or your internet connection." % repr(e))
-            elif isinstance(e, DispatchException):
+            elif isinstance(e, ablinfer.base.DispatchException):
                 slicer.util.errorDisplay("Error running model: %s\nThis is usually caused by a problem with your configuration or your input." % repr(e))
             else:
                 slicer.util.errorDisplay("Error running inference:\n"+''.join(traceback.format_exc()))
         else:
             if good_volume:
                 self.movingSelector.setCurrentNode(model_config["outputs"]["input_vol_resampled"]["value"])
-            self._infer_progress(DispatchStage.Postprocess, 1, 1, "Finished!")
+            self._infer_progress(ablinfer.constants.DispatchStage.Postprocess, 1, 1, "Finished!")
             self.switch_to_3dview()
             self.exportSelector.setCurrentNode(model_config["outputs"]["output_seg"]["value"])
 
@@ -1036,6 +1781,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             return
 
         target = qt.QFileDialog.getExistingDirectory(None, "Choose an output directory *MUST BE EMPTY*")
+        self.harden_moving_transforms()
         ABLTemporalBoneSegmentationModuleLogic.export_for_cardinalsim(self.movingSelector.currentNode(), self.exportSelector.currentNode(), target)
 
     def click_render_volume(self, checked):
@@ -1162,6 +1908,12 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
 # Main Logic
 class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
+    resampleCache = ResampleCache()
+    atlasResources = AtlasResources()
+    sideDetectionAtlases = {}  # (side, grid size) -> coarse copy of the atlas
+    sideDetectionMinimumConfidence = 0.05
+    fixedInputCache = {}  # key -> prepared fixed image, mask, their files and the mask bounds
+
     @staticmethod
     def update_slicer_view(moving, atlas, overlay_opacity):
         slicer.app.layoutManager().setLayout(21)
@@ -1179,7 +1931,7 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
     def initialize_fiducial_set(atlas_fiducial_node, fiducial_placer, name):
         fiducial_set = []
         for i in range(0, atlas_fiducial_node.GetNumberOfFiducials()):
-            f = {'label': atlas_fiducial_node.GetNthFiducialLabel(i), 'table': None, 'input_indices': [0, 0, 0], 'atlas_indices': [0, 0, 0]}
+            f = {'label': atlas_fiducial_node.GetNthFiducialLabel(i), 'table': None, 'input_indices': [0, 0, 0], 'atlas_indices': [0, 0, 0], 'residual': None}
             atlas_fiducial_node.GetNthFiducialPosition(i, f['atlas_indices'])
             fiducial_set.append(f)
         inputFiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
@@ -1192,47 +1944,58 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
 
     @staticmethod
     def load_atlas_and_fiducials_and_mask(side_indicator):
-        atlasNode = slicer.mrmlScene.GetFirstNodeByName('Atlas_' + side_indicator)
-        atlasFiducialNode = slicer.mrmlScene.GetFirstNodeByName('Atlas_' + side_indicator + ' Fiducials')
-        framePath = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + "/Resources/Atlases/"
-        if atlasNode is None:
-            ## Download the atlas from the git release
-            sums = {
-                "L": "SHA256:594d78fdd47b9e4e78b9edfe605eebdb11cdbb0aec690c89d2d3fe9b634a389f",
-                "R": "SHA256:258c1c140438134d15bca09c6289335248bb2a6dc415edd677fcf55f29e644a3",
-            }
+        return ABLTemporalBoneSegmentationModuleLogic.atlasResources.get(side_indicator)
 
-            logic = SampleData.SampleDataLogic()
-            window = slicer.util.createProgressDialog()
-
-            ## Show a progress window, per the wiki:
-            ## https://www.slicer.org/wiki/Documentation/Nightly/ScriptRepository#Load_volume_from_URL
-            def progress(msg, level=None):
-                print("Downloading atlas... %d%%" % logic.downloadPercent)
-                if window.wasCanceled:
-                    slicer.util.errorDisplay("Download canceled! This atlas file MUST be downloaded for this module to work properly.")
-                    raise Exception("Download canceled!")
-                window.show()
-                window.activateWindow()
-                window.setValue(int(logic.downloadPercent))
-                window.setLabelText("Downloading atlas...")
-                slicer.app.processEvents()
+    @staticmethod
+    def load_atlas(side_indicator):
+        return ABLTemporalBoneSegmentationModuleLogic.atlasResources.get(side_indicator)[0]
 
-            try:
-                logic.logMessage = progress
-                atlasNode, = logic.downloadFromURL(nodeNames="Atlas_"+side_indicator, fileNames="Atlas_%s.mha" % side_indicator, uris="https://github.com/Auditory-Biophysics-Lab/temporal-bone-segmentation/releases/download/v1.0/Atlas_%s.mha" % side_indicator, checksums=sums[side_indicator])
-            finally:
-                window.close()
-
-            atlasNode.HideFromEditorsOn()
-        if atlasFiducialNode is None:
-            atlasFiducialNode = slicer.util.loadMarkups(framePath + 'Fiducial_' + side_indicator + '.fcsv')
-            atlasFiducialNode.SetName('Atlas_' + side_indicator + ' Fiducials')
-            atlasFiducialNode.SetLocked(True)
-            atlasFiducialNode.HideFromEditorsOn()
-        framePath = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + "/Resources/Masks/"
-        maskNode = slicer.util.loadVolume(framePath + 'CochleaRegistrationMask_' + side_indicator + '.nrrd')
-        return atlasNode, atlasFiducialNode, maskNode
+    @staticmethod
+    def get_strided_image(node, target_size):
+        """Get a volume as a SimpleITK image in world space, keeping only every n-th voxel along each axis
+        so that no side is much longer than ``target_size``. Reading a strided view is far cheaper than
+        resampling the full volume. A SimpleITK image may be given instead of a node."""
+        if isinstance(node, sitk.Image):
+            step = max(1, int(math.ceil(max(node.GetSize()) / target_size)))
+            return node[::step, ::step, ::step]
+        array = slicer.util.arrayFromVolume(node)
+        step = max(1, int(math.ceil(max(array.shape) / target_size)))
+        image = sitk.GetImageFromArray(np.ascontiguousarray(array[::step, ::step, ::step]))
+        ijkToLPS = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ABLTemporalBoneSegmentationModuleLogic.get_world_ijk_to_ras(node)
+        spacing = np.linalg.norm(ijkToLPS[:3, :3], axis=0)
+        image.SetSpacing(tuple(spacing*step))
+        image.SetOrigin(tuple(ijkToLPS[:3, 3]))
+        image.SetDirection(tuple((ijkToLPS[:3, :3] / spacing).ravel()))
+        return image
+
+    @staticmethod
+    def detect_side(node, grid_size=32):
+        """Guess whether a volume shows a left or right temporal bone by aligning coarse copies of it with
+        both atlases (see ``compute_coarse_alignment``) and comparing the normalized cross-correlations.
+        Only proper rotations are tried, so the mirrored atlas cannot be matched as well. Both
+        comparisons run in parallel. The atlases are only read if they are already available locally,
+        and no nodes are created.
+
+        :return: "L" or "R", a confidence between 0 and 1 and the correlation with each atlas, or None if
+            the atlases are not available yet.
+        """
+        start = time.perf_counter()
+        cache = ABLTemporalBoneSegmentationModuleLogic.sideDetectionAtlases
+        for side in ('L', 'R'):
+            if (side, grid_size) not in cache:
+                atlas = ABLTemporalBoneSegmentationModuleLogic.atlasResources.get_local_image(side)
+                if atlas is None: return None
+                atlas = ABLTemporalBoneSegmentationModuleLogic.get_strided_image(atlas, 2*grid_size)
+                cache[(side, grid_size)] = ABLTemporalBoneSegmentationModuleLogic.get_coarse_grid(atlas, grid_size)
+        image = ABLTemporalBoneSegmentationModuleLogic.get_strided_image(node, 2*grid_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {side: executor.submit(ABLTemporalBoneSegmentationModuleLogic.compute_coarse_alignment, cache[(side, grid_size)], image, grid_size) for side in ('L', 'R')}
+            scores = {side: future.result()[1] for side, future in futures.items()}
+        side = max(scores, key=scores.get)
+        other = 'R' if side == 'L' else 'L'
+        confidence = min(1.0, max(0.0, scores[side] - scores[other]) / (abs(scores[side]) + abs(scores[other]) + 1e-12))
+        logging.info("Detected side %s of %s in %.2f s (confidence %.2f, NCC %s)" % (side, node.GetName(), time.perf_counter() - start, confidence, scores))
+        return side, confidence, scores
 
     @staticmethod
     def get_um_spacing(spacing):
@@ -1253,77 +2016,1047 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         return resampledImage
 
     @staticmethod
-    def pull_node_resample_push(node, spacing_in_um, interpolation):
-        image = sitku.PullVolumeFromSlicer(node.GetID())
-        resampledImage = ABLTemporalBoneSegmentationModuleLogic().resample_image(image, spacing_in_um, interpolation)
-        resampledNode = sitku.PushVolumeToSlicer(resampledImage, None, node.GetName() + "_Resampled" + str(spacing_in_um) + '', "vtkMRMLScalarVolumeNode")
+    def create_resampled_node(node, spacing, size):
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(size)
+        imageData.AllocateScalars(node.GetImageData().GetScalarType(), 1)
+        outputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", node.GetName() + "_Resampled" + str(spacing))
+        directions = vtk.vtkMatrix4x4()
+        node.GetIJKToRASDirectionMatrix(directions)
+        outputNode.SetIJKToRASDirectionMatrix(directions)
+        outputNode.SetOrigin(node.GetOrigin())
+        outputNode.SetSpacing(spacing)
+        outputNode.SetAndObserveImageData(imageData)
+        outputNode.CreateDefaultDisplayNodes()
+        return outputNode
+
+    @staticmethod
+    def resample_node_streamed(node, spacing, interpolation, memory_budget_mb=512):
+        """Resample a volume node in z-slabs so that peak memory is bounded by a budget.
+
+        Each output slab only pulls the input slices it needs (plus a margin for the interpolation
+        kernel) out of the node's voxel array, and is written straight into the preallocated output
+        image, so neither the full input nor a second full output is ever copied.
+
+        :param node: The scalar volume node to resample. Its parent transform, if any, is ignored.
+        :param spacing: The target spacing, in mm.
+        :param interpolation: The SimpleITK interpolator to use.
+        :param memory_budget_mb: The approximate working memory allowed for a single slab, in MB.
+        """
+        inputArray = slicer.util.arrayFromVolume(node)  ## (k, j, i) view of the node's voxels, no copy
+        oldSpacing = node.GetSpacing()
+        oldSize = inputArray.shape[::-1]
+        newSize = [int(a * (b / c)) for a, b, c in zip(oldSize, [float("%.3f" % f) for f in oldSpacing], spacing)]
+
+        ## Allocate the output image once and fill it in place
+        outputNode = ABLTemporalBoneSegmentationModuleLogic.create_resampled_node(node, spacing, newSize)
+        outputArray = slicer.util.arrayFromVolume(outputNode)
+
+        ## Size the slabs: each output slice costs its resampled copy, and each input slice costs its
+        ## copy into SimpleITK plus the interpolator's double precision coefficients
+        margin = next((i['margin'] for i in supportedResampleInterpolations if i['value'] == interpolation), 4)
+        ratio = spacing[2] / oldSpacing[2]
+        inputSliceBytes = oldSize[0] * oldSize[1] * (inputArray.itemsize + 8)
+        outputSliceBytes = newSize[0] * newSize[1] * outputArray.itemsize
+        available = memory_budget_mb * 1024**2 - (2*margin + 2) * inputSliceBytes
+        slabSize = max(1, int(available / (outputSliceBytes + ratio * inputSliceBytes)))
+
+        ## The output shares the input's origin and direction, so slabs can be resampled in a plain
+        ## index-aligned frame where only the offset along k matters
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetInterpolator(interpolation)
+        resampler.SetOutputSpacing(spacing)
+        for k0 in range(0, newSize[2], slabSize):
+            k1 = min(k0 + slabSize, newSize[2])
+            z0 = max(0, int(math.floor(k0 * ratio)) - margin)
+            z1 = min(oldSize[2], int(math.ceil((k1 - 1) * ratio)) + margin + 1)
+            slab = sitk.GetImageFromArray(inputArray[z0:z1])
+            slab.SetSpacing(oldSpacing)
+            slab.SetOrigin((0, 0, z0 * oldSpacing[2]))
+            resampler.SetOutputOrigin((0, 0, k0 * spacing[2]))
+            resampler.SetSize([newSize[0], newSize[1], k1 - k0])
+            resampledSlab = resampler.Execute(slab)
+            outputArray[k0:k1] = sitk.GetArrayViewFromImage(resampledSlab)
+            del slab, resampledSlab
+        slicer.util.arrayFromVolumeModified(outputNode)
+        return outputNode
+
+    @staticmethod
+    def pull_node_resample_push(node, spacing_in_um, interpolation, memory_budget_mb=None, use_cache=True):
+        cache = ABLTemporalBoneSegmentationModuleLogic.resampleCache
+        if use_cache:
+            cached = cache.get(node, spacing_in_um, interpolation)
+            if cached is not None:
+                logging.info("Reusing cached resample of " + node.GetName())
+                resampledNode = ABLTemporalBoneSegmentationModuleLogic.create_resampled_node(node, spacing_in_um, cached.shape[::-1])
+                slicer.util.arrayFromVolume(resampledNode)[:] = cached
+                slicer.util.arrayFromVolumeModified(resampledNode)
+                resampledNode.SetAndObserveTransformNodeID(node.GetTransformNodeID())
+                return resampledNode
+        if memory_budget_mb is not None:
+            resampledNode = ABLTemporalBoneSegmentationModuleLogic.resample_node_streamed(node, spacing_in_um, interpolation, memory_budget_mb)
+        else:
+            image = sitku.PullVolumeFromSlicer(node.GetID())
+            resampledImage = ABLTemporalBoneSegmentationModuleLogic().resample_image(image, spacing_in_um, interpolation)
+            resampledNode = sitku.PushVolumeToSlicer(resampledImage, None, node.GetName() + "_Resampled" + str(spacing_in_um) + '', "vtkMRMLScalarVolumeNode")
+        ## A streamed resample is bounded in memory, so its result is written through to disk rather than copied
+        if use_cache: cache.put(node, spacing_in_um, interpolation, slicer.util.arrayFromVolume(resampledNode), copy=memory_budget_mb is None)
+        resampledNode.SetAndObserveTransformNodeID(node.GetTransformNodeID())
         return resampledNode
 
     @staticmethod
-    def apply_fiducial_registration(moving_node, atlas_fiducial_node, input_fiducial_node):
-        # create temporary trimmed atlas fiducial set node (locked & hidden)
-        trimmed_atlas_fiducial_node = slicer.vtkMRMLMarkupsFiducialNode()
-        for i_f in range(0, input_fiducial_node.GetNumberOfFiducials()):
-            for a_f in range(0, atlas_fiducial_node.GetNumberOfFiducials()):
-                if input_fiducial_node.GetNthFiducialLabel(i_f) == atlas_fiducial_node.GetNthFiducialLabel(a_f):
-                    pos = [0, 0, 0]
-                    atlas_fiducial_node.GetNthFiducialPosition(a_f, pos)
-                    trimmed_atlas_fiducial_node.AddFiducialFromArray(pos, atlas_fiducial_node.GetNthFiducialLabel(a_f))
-                    break
-        slicer.mrmlScene.AddNode(trimmed_atlas_fiducial_node)
-        trimmed_atlas_fiducial_node.SetName("Trimmed Atlas Fiducials")
-        trimmed_atlas_fiducial_node.SetLocked(True)
-        for f in range(0, trimmed_atlas_fiducial_node.GetNumberOfFiducials()): trimmed_atlas_fiducial_node.SetNthFiducialVisibility(f, False)
-        # process
-        transform_node = slicer.vtkMRMLTransformNode()
-        transform_node.SetName(moving_node.GetName() + ' Fiducial transform')
-        slicer.mrmlScene.AddNode(transform_node)
-        output = slicer.cli.run(slicer.modules.fiducialregistration, None, wait_for_completion=True, parameters={
-            'fixedLandmarks'   : trimmed_atlas_fiducial_node.GetID(),
-            'movingLandmarks'  : input_fiducial_node.GetID(),
-            'transformType'    : 'Rigid',
-            "saveTransform"    : transform_node.GetID()
-        })
-        moving_node.ApplyTransform(transform_node.GetTransformToParent())
-        # clean up
-        # slicer.mrmlScene.RemoveNode(transform)
-        slicer.mrmlScene.RemoveNode(trimmed_atlas_fiducial_node)
+    def get_world_ijk_to_ras(node):
+        ijkToRAS = vtk.vtkMatrix4x4()
+        node.GetIJKToRASMatrix(ijkToRAS)
+        matrix = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+        transformNode = node.GetParentTransformNode()
+        if transformNode is not None:
+            if not transformNode.IsTransformToWorldLinear(): raise ValueError(node.GetName() + " is under a non-linear transform")
+            toWorld = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformToWorld(toWorld)
+            matrix = slicer.util.arrayFromVTKMatrix(toWorld) @ matrix
+        return matrix
+
+    @staticmethod
+    def append_transform(node, transform_node):
+        ## Walk up to the outermost transform so that the new one is applied last
+        top = node
+        while top.GetParentTransformNode() is not None:
+            top = top.GetParentTransformNode()
+            if top is transform_node: return
+        top.SetAndObserveTransformNodeID(transform_node.GetID())
+
+    @staticmethod
+    def create_world_reference_volume(node, name=None):
+        """Create a volume sharing the voxels of ``node``, with its linear transforms folded into its geometry."""
+        reference = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name or node.GetName() + " Reference")
+        reference.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ABLTemporalBoneSegmentationModuleLogic.get_world_ijk_to_ras(node)))
+        reference.SetAndObserveImageData(node.GetImageData())
+        reference.CreateDefaultDisplayNodes()
+        if node.GetDisplayNode() is not None:
+            reference.GetDisplayNode().SetAutoWindowLevel(False)
+            reference.GetDisplayNode().SetWindowLevel(node.GetDisplayNode().GetWindow(), node.GetDisplayNode().GetLevel())
+        reference.HideFromEditorsOn()
+        return reference
+
+    @staticmethod
+    def crop_and_resample(node, roi_node, spacing, interpolation, fill_value=-3000):
+        """Crop a volume to an ROI and resample it to a new spacing in a single interpolation pass.
+
+        Only the ROI's footprint in the input (plus a margin for the interpolation kernel) is pulled out
+        of the volume, and the output grid is aligned to RAS. A linear parent transform on the volume is
+        folded into the input geometry instead of being hardened.
+
+        :param node: The volume node to crop.
+        :param roi_node: The ROI node to crop to.
+        :param spacing: The output spacing, in mm.
+        :param interpolation: The SimpleITK interpolator to use.
+        :param fill_value: The value given to output voxels that fall outside of the input.
+        :return: The output volume node, and a dict with the number of voxels interpolated and the voxels
+                 and (estimated) seconds saved compared to resampling the whole volume then cropping it.
+        """
+        start = time.time()
+        bounds = [0]*6
+        roi_node.GetRASBounds(bounds)
+        lower, upper = np.array(bounds[0::2]), np.array(bounds[1::2])
+        spacing = np.array(spacing, dtype=float)
+        size = np.maximum(1, np.round((upper - lower) / spacing)).astype(int)
+
+        ## Find the ROI's footprint in the input's voxel grid
+        ijkToWorld = ABLTemporalBoneSegmentationModuleLogic.get_world_ijk_to_ras(node)
+        corners = np.array([[x, y, z, 1] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+        ijkCorners = (np.linalg.inv(ijkToWorld) @ corners.T)[:3].T
+        inputArray = slicer.util.arrayFromVolume(node)
+        dimensions = np.array(inputArray.shape[::-1])
+        margin = next((i['margin'] for i in supportedResampleInterpolations if i['value'] == interpolation), 4)
+        low = np.maximum(0, np.floor(ijkCorners.min(axis=0)).astype(int) - margin)
+        high = np.minimum(dimensions - 1, np.ceil(ijkCorners.max(axis=0)).astype(int) + margin)
+        if np.any(low > high): raise ValueError("The ROI does not overlap " + node.GetName())
+        footprint = sitk.GetImageFromArray(np.ascontiguousarray(inputArray[low[2]:high[2] + 1, low[1]:high[1] + 1, low[0]:high[0] + 1]))
+
+        ## Slicer works in RAS while ITK works in LPS
+        rasToLPS = np.diag([-1.0, -1.0, 1.0])
+        inputSpacing = np.linalg.norm(ijkToWorld[:3, :3], axis=0)
+        footprint.SetSpacing(inputSpacing.tolist())
+        footprint.SetDirection((rasToLPS @ (ijkToWorld[:3, :3] / inputSpacing)).flatten().tolist())
+        footprint.SetOrigin((rasToLPS @ (ijkToWorld @ np.append(low, 1))[:3]).tolist())
+
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetInterpolator(interpolation)
+        resampler.SetDefaultPixelValue(fill_value)
+        resampler.SetOutputSpacing(spacing.tolist())
+        resampler.SetSize(size.tolist())
+        resampler.SetOutputDirection(rasToLPS.flatten().tolist())
+        resampler.SetOutputOrigin((rasToLPS @ (lower + spacing/2)).tolist())
+        outputImage = resampler.Execute(footprint)
+        del footprint
+        outputNode = sitku.PushVolumeToSlicer(outputImage, None, node.GetName() + "_Crop", "vtkMRMLScalarVolumeNode")
+
+        ## The two-step path interpolates the whole volume at the new spacing, then the ROI again; the time
+        ## saved is estimated from this pass's throughput
+        elapsed = time.time() - start
+        fusedVoxels = int(np.prod(size))
+        twoStepVoxels = int(np.prod(dimensions * inputSpacing / spacing)) + fusedVoxels
+        report = {
+            'voxels': fusedVoxels,
+            'voxels_saved': twoStepVoxels - fusedVoxels,
+            'seconds': elapsed,
+            'seconds_saved': elapsed * (twoStepVoxels - fusedVoxels) / fusedVoxels,
+        }
+        logging.info("Fused crop and resample of %s: %s" % (node.GetName(), report))
+        return outputNode, report
+
+    @staticmethod
+    def get_fiducial_positions(fiducial_node):
+        positions = {}
+        for i in range(fiducial_node.GetNumberOfFiducials()):
+            pos = [0, 0, 0]
+            fiducial_node.GetNthFiducialPosition(i, pos)
+            positions[fiducial_node.GetNthFiducialLabel(i)] = pos
+        return positions
+
+    @staticmethod
+    def compute_rigid_landmark_transform(fixed_points, moving_points):
+        """Find the least-squares rigid transform taking the moving points onto the fixed points (Kabsch).
+
+        :param fixed_points: An (n, 3) array of target points.
+        :param moving_points: An (n, 3) array of the corresponding points to be moved.
+        :return: The 4x4 transform matrix, and the distance of each moved point from its target.
+        """
+        fixed_points, moving_points = np.asarray(fixed_points, dtype=float), np.asarray(moving_points, dtype=float)
+        fixedCentroid, movingCentroid = fixed_points.mean(axis=0), moving_points.mean(axis=0)
+        u, _, vt = np.linalg.svd((moving_points - movingCentroid).T @ (fixed_points - fixedCentroid))
+        ## Flip the least significant axis if needed so that we get a rotation rather than a reflection
+        reflection = 1.0 if np.linalg.det(vt.T @ u.T) >= 0 else -1.0
+        rotation = vt.T @ np.diag([1.0, 1.0, reflection]) @ u.T
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = fixedCentroid - rotation @ movingCentroid
+        residuals = np.linalg.norm(moving_points @ rotation.T + matrix[:3, 3] - fixed_points, axis=1)
+        return matrix, residuals
+
+    @staticmethod
+    def update_fiducial_transform(transform_node, atlas_fiducial_node, input_fiducial_node):
+        """Solve the rigid fiducial registration in-process and write it into the transform node.
+
+        :return: A dict mapping each matched fiducial's label to its residual, and the RMS error (both in mm).
+        """
+        atlas = ABLTemporalBoneSegmentationModuleLogic.get_fiducial_positions(atlas_fiducial_node)
+        inputs = ABLTemporalBoneSegmentationModuleLogic.get_fiducial_positions(input_fiducial_node)
+        labels = [label for label in inputs if label in atlas]
+        if len(labels) < 3: raise ValueError("At least 3 matching fiducials are required, got %d" % len(labels))
+        matrix, residuals = ABLTemporalBoneSegmentationModuleLogic.compute_rigid_landmark_transform([atlas[l] for l in labels], [inputs[l] for l in labels])
+        transform_node.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(matrix))
+        return dict(zip(labels, residuals.tolist())), float(np.sqrt(np.mean(residuals**2)))
+
+    @staticmethod
+    def apply_fiducial_registration(moving_node, atlas_fiducial_node, input_fiducial_node, transform_node=None):
+        if transform_node is None: transform_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", moving_node.GetName() + ' Fiducial transform')
+        residuals, rms = ABLTemporalBoneSegmentationModuleLogic.update_fiducial_transform(transform_node, atlas_fiducial_node, input_fiducial_node)
+        moving_node.SetAndObserveTransformNodeID(transform_node.GetID())
+        logging.debug("Fiducial registration RMS error: %.3f mm" % rms)
+        return moving_node, residuals, rms
+
+    @staticmethod
+    def harden_fiducial_registration(transformed_node, moving_node):
+        ## The fiducial transform is linear, so hardening it into the moving volume only updates its
+        ## geometry; the voxels are not resampled
+        transform_node = transformed_node.GetParentTransformNode()
+        transformed_node.SetAndObserveTransformNodeID(None)
+        ABLTemporalBoneSegmentationModuleLogic.append_transform(moving_node, transform_node)
+        moving_node.HardenTransform()
+        slicer.mrmlScene.RemoveNode(transformed_node)
+        slicer.mrmlScene.RemoveNode(transform_node)
         return moving_node
 
     @staticmethod
-    def harden_fiducial_registration(transformed_node):
-        transformed_node.HardenTransform()
-        return transformed_node
+    def prepare_elastix_registration(elastix, fixed_image, moving_image, fixed_mask, moving_mask, parameter_filenames, write_iterations=False):
+        """Write the registration inputs to a new temporary directory and build Elastix's command line.
+
+        Inputs given as file paths are passed to Elastix as they are. With ``write_iterations``, the
+        parameter files are copied with WriteTransformParametersEachIteration enabled, so that the
+        registration can be stopped at any iteration.
+
+        :return: The temporary directory and the list of Elastix arguments.
+        """
+        tempDir = tempfile.mkdtemp(prefix='ABLRegistration_', dir=elastix.getTempDirectoryBase())
+        inputDir = os.path.join(tempDir, 'input')
+        resultDir = os.path.join(tempDir, 'result-transform')
+        os.makedirs(inputDir)
+        os.makedirs(resultDir)
+        args = []
+        for image, filename, param in [(fixed_image, 'fixed.mha', '-f'), (moving_image, 'moving.mha', '-m'), (fixed_mask, 'fixedMask.mha', '-fMask'), (moving_mask, 'movingMask.mha', '-mMask')]:
+            if image is None: continue
+            if isinstance(image, str):
+                ## Already on disk, e.g. cached fixed inputs
+                args += [param, image]
+                continue
+            path = os.path.join(inputDir, filename)
+            sitk.WriteImage(image, path, False)
+            args += [param, path]
+        args += ['-out', resultDir]
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        for filename in parameter_filenames:
+            path = os.path.join(parametersDir, filename)
+            if write_iterations:
+                copyPath = os.path.join(inputDir, os.path.basename(filename))
+                ABLTemporalBoneSegmentationModuleLogic.write_elastix_parameters(path, copyPath, {'WriteTransformParametersEachIteration': 'true'})
+                path = copyPath
+            args += ['-p', path]
+        return tempDir, args
+
+    @staticmethod
+    def write_elastix_parameters(source_path, path, overrides):
+        """Copy an Elastix parameter file, replacing or adding the given parameters.
+
+        Strings are written quoted, numbers as they are and sequences as space-separated values. An
+        existing file with the same content is left alone, and a changed one is replaced atomically, so
+        registrations already reading it never see it partially written.
+        """
+        def format_value(value):
+            if isinstance(value, (list, tuple)): return ' '.join(format_value(v) for v in value)
+            return '"%s"' % value if isinstance(value, str) else str(value)
+        with open(source_path) as f: text = f.read()
+        for name, value in overrides.items():
+            text = re.sub(r'^\s*\(%s\s.*\)\s*$' % name, '', text, flags=re.MULTILINE)
+            text += '\n(%s %s)' % (name, format_value(value))
+        text += '\n'
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == text: return
+        handle, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.txt')
+        try:
+            with os.fdopen(handle, 'w') as f: f.write(text)
+            os.replace(tempPath, path)
+        except BaseException:
+            if os.path.exists(tempPath): os.remove(tempPath)
+            raise
+
+    @staticmethod
+    def read_elastix_parameters(path):
+        parameters = {}
+        with open(path) as f:
+            for line in f:
+                m = re.match(r'\s*\((\w+)\s+(.*)\)', line)
+                if m is not None: parameters[m.group(1)] = [v.strip('"') for v in re.findall(r'"[^"]*"|\S+', m.group(2))]
+        return parameters
+
+    @staticmethod
+    def read_elastix_transform(path):
+        """Read an Elastix transform parameter file (and its initial transforms) as a 4x4 matrix.
+
+        The matrix maps fixed image points to moving image points in LPS, as Elastix does.
+        """
+        return ABLTemporalBoneSegmentationModuleLogic.elastix_parameters_to_matrix(ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(path))
+
+    @staticmethod
+    def elastix_parameters_to_matrix(parameters):
+        values = [float(v) for v in parameters['TransformParameters']]
+        center = np.array([float(v) for v in parameters.get('CenterOfRotationPoint', [0, 0, 0])])
+        transform = parameters['Transform'][0]
+        if transform == 'EulerTransform':
+            cx, cy, cz = np.cos(values[:3])
+            sx, sy, sz = np.sin(values[:3])
+            rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+            ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+            rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+            rotation = rz @ ry @ rx if parameters.get('ComputeZYX', ['false'])[0] == 'true' else rz @ rx @ ry
+            translation = values[3:6]
+        elif transform == 'AffineTransform':
+            rotation, translation = np.array(values[:9]).reshape(3, 3), values[9:12]
+        elif transform == 'TranslationTransform':
+            rotation, translation = np.eye(3), values[:3]
+        else:
+            raise ValueError("Unsupported Elastix transform: " + transform)
+        matrix = np.eye(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = center + np.array(translation) - rotation @ center
+        initial = parameters.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+        if initial != 'NoInitialTransform':
+            ## Composed transforms apply the initial transform first
+            matrix = matrix @ ABLTemporalBoneSegmentationModuleLogic.read_elastix_transform(initial)
+        return matrix
+
+    @staticmethod
+    def get_resident_memory():
+        """Get the resident memory of this process in bytes, with psutil if installed or else from /proc.
+
+        :return: The resident memory, or None where neither is available.
+        """
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            pass
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    @staticmethod
+    def get_elastix_memory_backend():
+        """Find Python bindings able to run Elastix in memory, either SimpleElastix or itk-elastix.
+
+        Setting "abltbs_elastix_backend" to "disk" forces the executable to be used.
+
+        :return: "SimpleElastix", "itk-elastix" or None if neither is usable.
+        """
+        if slicer.app.settings().value("abltbs_elastix_backend", "auto") == "disk": return None
+        if hasattr(sitk, 'ElastixImageFilter'): return "SimpleElastix"
+        try:
+            import itk
+            if hasattr(itk, 'ElastixRegistrationMethod'): return "itk-elastix"
+        except ImportError:
+            pass
+        return None
+
+    @staticmethod
+    def run_elastix_in_memory(backend, fixed_image, moving_image, fixed_mask, moving_mask, parameter_paths, threads=None):
+        """Register SimpleITK images with the Elastix Python bindings.
+
+        No result image is generated; only the transform parameters are returned. ``threads`` limits the
+        threads Elastix uses, like the executable's -threads argument.
+
+        :return: The final transform parameter map, as a dictionary of string lists.
+        """
+        if backend == "SimpleElastix":
+            elastixFilter = sitk.ElastixImageFilter()
+            elastixFilter.LogToConsoleOff()
+            elastixFilter.LogToFileOff()
+            elastixFilter.SetFixedImage(fixed_image)
+            elastixFilter.SetMovingImage(moving_image)
+            if fixed_mask is not None: elastixFilter.SetFixedMask(sitk.Cast(fixed_mask, sitk.sitkUInt8))
+            if moving_mask is not None: elastixFilter.SetMovingMask(sitk.Cast(moving_mask, sitk.sitkUInt8))
+            parameterMaps = sitk.VectorOfParameterMap()
+            for path in parameter_paths:
+                parameterMap = sitk.ReadParameterFile(path)
+                parameterMap['WriteResultImage'] = ['false']
+                parameterMaps.append(parameterMap)
+            elastixFilter.SetParameterMap(parameterMaps)
+            if threads is not None: elastixFilter.SetNumberOfThreads(threads)
+            elastixFilter.Execute()
+            transformMap = elastixFilter.GetTransformParameterMap()[-1]
+            return {k: list(transformMap[k]) for k in transformMap.keys()}
+
+        import itk
+        def to_itk(image, pixel_type):
+            itkImage = itk.GetImageFromArray(sitk.GetArrayViewFromImage(image).astype(pixel_type))
+            itkImage.SetOrigin(image.GetOrigin())
+            itkImage.SetSpacing(image.GetSpacing())
+            itkImage.SetDirection(itk.matrix_from_array(np.array(image.GetDirection()).reshape(3, 3)))
+            return itkImage
+        parameterObject = itk.ParameterObject.New()
+        for path in parameter_paths:
+            parameterObject.AddParameterFile(path)
+            parameterObject.SetParameter(parameterObject.GetNumberOfParameterMaps() - 1, 'WriteResultImage', 'false')
+            if threads is not None: parameterObject.SetParameter(parameterObject.GetNumberOfParameterMaps() - 1, 'MaximumNumberOfThreads', str(threads))
+        method = itk.ElastixRegistrationMethod.New(to_itk(fixed_image, np.float32), to_itk(moving_image, np.float32))
+        method.SetParameterObject(parameterObject)
+        method.SetLogToConsole(False)
+        if fixed_mask is not None: method.SetFixedMask(to_itk(fixed_mask, np.uint8))
+        if moving_mask is not None: method.SetMovingMask(to_itk(moving_mask, np.uint8))
+        method.UpdateLargestPossibleRegion()
+        transformObject = method.GetTransformParameterObject()
+        transformMap = transformObject.GetParameterMap(transformObject.GetNumberOfParameterMaps() - 1)
+        return {k: list(transformMap[k]) for k in transformMap.keys()}
+
+    @staticmethod
+    def estimate_elastix_io_bytes(fixed_image, moving_image, fixed_mask, moving_mask):
+        """Estimate the bytes a registration run as an executable would write to disk: the uncompressed
+        images and the result image (``ResultImagePixelType "short"``). Not a measurement, as nothing is
+        written in memory."""
+        total = 0
+        for image in (fixed_image, moving_image, fixed_mask, moving_mask):
+            if image is None: continue
+            total += image.GetNumberOfPixels()*image.GetSizeOfPixelComponent()*image.GetNumberOfComponentsPerPixel()
+        return total + moving_image.GetNumberOfPixels()*2
 
     @staticmethod
-    def apply_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback, copy=True):
+    def get_directory_bytes(path):
+        """Measure the total size of the files under ``path``."""
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try: total += os.path.getsize(os.path.join(root, name))
+                except OSError: pass
+        return total
+
+    @staticmethod
+    def get_image_footprint(source):
+        """Get the dimensions, spacing and bytes per voxel of a volume node, or of an image file from its header alone.
+
+        :return: The three values, or None if the node has no image.
+        """
+        if isinstance(source, str):
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(source)
+            reader.ReadImageInformation()
+            pixelBytes = sitk.Image([1]*reader.GetDimension(), reader.GetPixelID()).GetSizeOfPixelComponent()
+            return np.array(reader.GetSize()), np.array(reader.GetSpacing()), pixelBytes*reader.GetNumberOfComponents()
+        image = source.GetImageData()
+        if image is None: return None
+        return np.array(image.GetDimensions()), np.array(source.GetSpacing()), image.GetScalarSize()*image.GetNumberOfScalarComponents()
+
+    @staticmethod
+    def estimate_registration_memory(fixed_node, moving_node, parameter_filenames=("Parameters_Rigid.txt",)):
+        """Estimate the peak memory of one registration, in bytes.
+
+        Each image is held as read and as cast to the internal pixel type of the parameter file, along
+        with its current pyramid level. A B-spline transform adds its coefficients (doubles) on the grid
+        of the final resolution. The volumes may also be given as file paths, which are not loaded.
+        """
+        pixelBytes = {'char': 1, 'unsigned char': 1, 'short': 2, 'unsigned short': 2, 'int': 4, 'unsigned int': 4, 'float': 4, 'double': 8}
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        parameters = {}
+        for filename in parameter_filenames: parameters.update(ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(os.path.join(parametersDir, filename)))
+        total = 64*2**20  # the process itself
+        footprints = {}
+        for node, kind in ((fixed_node, 'Fixed'), (moving_node, 'Moving')):
+            footprints[kind] = ABLTemporalBoneSegmentationModuleLogic.get_image_footprint(node)
+            if footprints[kind] is None: continue
+            dimensions, _, inputBytes = footprints[kind]
+            voxels = np.prod(dimensions)
+            internal = pixelBytes.get(parameters.get(kind + 'InternalImagePixelType', ['float'])[0], 4)
+            ## Recursive and shrinking pyramids downsample, so the levels add up to 1 + 1/8 + 1/64 + ... of the
+            ## image; a smoothing pyramid keeps every level at full size
+            pyramid = 2.0 if 'Smoothing' in parameters.get(kind + 'ImagePyramid', [''])[0] else 8/7
+            total += voxels*(inputBytes + internal*pyramid)
+        if 'BSpline' in parameters.get('Transform', [''])[0] and footprints['Fixed'] is not None:
+            dimensions, spacing, _ = footprints['Fixed']
+            gridSpacing = float(parameters.get('FinalGridSpacingInPhysicalUnits', [0])[0]) or 16*spacing.min()
+            gridPoints = np.prod(np.ceil(dimensions*spacing/gridSpacing) + 3)
+            total += gridPoints*3*8
+        return int(total)
+
+    @staticmethod
+    def get_mask_physical_bounds(mask):
+        """Get the physical (LPS) bounding box of a mask's nonzero voxels.
+
+        :return: The lower and upper corners, or None if the mask is empty.
+        """
+        array = sitk.GetArrayViewFromImage(mask)
+        index_bounds = []
+        ## Project onto each axis instead of listing every nonzero voxel; arrays are indexed KJI
+        for axis in (2, 1, 0):
+            occupied = np.flatnonzero(array.any(axis=tuple(a for a in range(3) if a != axis)))
+            if occupied.size == 0: return None
+            index_bounds.append((occupied[0], occupied[-1]))
+        corners = np.array([mask.TransformIndexToPhysicalPoint((int(i), int(j), int(k)))
+                            for i in index_bounds[0] for j in index_bounds[1] for k in index_bounds[2]])
+        return corners.min(axis=0), corners.max(axis=0)
+
+    @staticmethod
+    def get_physical_bounds_overlap(image, lower, upper, margin_mm):
+        """Get the fraction of a physical box grown by a margin that lies inside an image, in voxels."""
+        lower = np.asarray(lower) - margin_mm
+        upper = np.asarray(upper) + margin_mm
+        corners = np.array([image.TransformPhysicalPointToContinuousIndex((x, y, z))
+                            for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+        start, stop = corners.min(axis=0), corners.max(axis=0)
+        inside = np.clip(np.minimum(stop, np.array(image.GetSize()) - 1) - np.maximum(start, 0), 0, None)
+        return float(np.prod(inside)/max(np.prod(stop - start), 1e-9))
+
+    @staticmethod
+    def crop_image_to_physical_bounds(image, lower, upper, margin_mm):
+        """Crop an image to the voxels covering a physical box grown by a margin.
+
+        Slicing keeps the physical position of every voxel, so transforms computed on the crop
+        apply unchanged to the full image.
+        """
+        lower = np.asarray(lower) - margin_mm
+        upper = np.asarray(upper) + margin_mm
+        corners = np.array([image.TransformPhysicalPointToContinuousIndex((x, y, z))
+                            for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+        size = np.array(image.GetSize())
+        start = np.clip(np.floor(corners.min(axis=0)).astype(int), 0, size)
+        stop = np.clip(np.ceil(corners.max(axis=0)).astype(int) + 1, 0, size)
+        if np.any(stop - start < 4): raise ValueError("Cropped region is too small to register")
+        return image[int(start[0]):int(stop[0]), int(start[1]):int(stop[1]), int(start[2]):int(stop[2])]
+
+    @staticmethod
+    def get_registration_cache_dir(kind):
+        root = slicer.app.settings().value("abltbs_registration_cache_dir") or os.path.join(slicer.app.cachePath, 'ABLTemporalBoneSegmentation')
+        return os.path.join(root, kind)
+
+    @staticmethod
+    def get_registration_result_key(atlas_node, moving_node, mask_node, parameter_filenames, crop_margin_mm, starts=1):
+        """Hash everything that determines a rigid registration's result: the moving volume's voxels and
+        world geometry (so any initial fiducial transform is included), the atlas and mask, the
+        parameter files, the crop margin and the number of starts."""
+        resampleCache = ABLTemporalBoneSegmentationModuleLogic.resampleCache
+        h = hashlib.blake2b(digest_size=16)
+        h.update(resampleCache.get_content_hash(moving_node).encode())
+        h.update(np.round(ABLTemporalBoneSegmentationModuleLogic.get_world_ijk_to_ras(moving_node), 9).tobytes())
+        ## A single start is left out of the key, so that single-start results keep their keys
+        h.update(repr((resampleCache.get_volume_key(atlas_node), None if mask_node is None else resampleCache.get_volume_key(mask_node), crop_margin_mm)
+                      + ((starts,) if starts > 1 else ())).encode())
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        for filename in parameter_filenames:
+            with open(os.path.join(parametersDir, filename), 'rb') as f: h.update(f.read())
+        return h.hexdigest()
+
+    @staticmethod
+    def get_fixed_registration_inputs(fixed_node, mask_node, margin_mm, parameter_filenames):
+        """Get the fixed image and mask as Elastix will use them: cropped to the mask's bounding box
+        grown by ``margin_mm`` (uncropped if negative) and cast to the internal pixel type.
+
+        The atlas never changes, so the prepared inputs are kept in memory and in the cache directory
+        (see ``get_registration_cache_dir``). They are keyed by the atlas and mask contents and
+        geometry, the margin and the internal pixel type. Elastix still builds the image pyramid itself.
+
+        :return: The fixed image, the mask, the files holding them and the mask's physical bounds.
+        """
+        parameters = {}
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        for filename in parameter_filenames: parameters.update(ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(os.path.join(parametersDir, filename)))
+        pixelType = parameters.get('FixedInternalImagePixelType', ['float'])[0]
+        resampleCache = ABLTemporalBoneSegmentationModuleLogic.resampleCache
+        key = hashlib.blake2b(repr((resampleCache.get_volume_key(fixed_node), resampleCache.get_volume_key(mask_node), margin_mm, pixelType)).encode(), digest_size=16).hexdigest()
+        if key in ABLTemporalBoneSegmentationModuleLogic.fixedInputCache: return ABLTemporalBoneSegmentationModuleLogic.fixedInputCache[key]
+
+        cacheDir = ABLTemporalBoneSegmentationModuleLogic.get_registration_cache_dir('fixed')
+        fixedPath, maskPath = os.path.join(cacheDir, key + '_fixed.mha'), os.path.join(cacheDir, key + '_mask.mha')
+        if os.path.exists(fixedPath) and os.path.exists(maskPath):
+            fixedImage, maskImage = sitk.ReadImage(fixedPath), sitk.ReadImage(maskPath)
+        else:
+            start = time.perf_counter()
+            fixedImage, maskImage = sitku.PullVolumeFromSlicer(fixed_node.GetID()), sitku.PullVolumeFromSlicer(mask_node.GetID())
+            bounds = ABLTemporalBoneSegmentationModuleLogic.get_mask_physical_bounds(maskImage)
+            if bounds is not None and margin_mm >= 0:
+                crop = ABLTemporalBoneSegmentationModuleLogic.crop_image_to_physical_bounds
+                fixedImage, maskImage = crop(fixedImage, *bounds, margin_mm), crop(maskImage, *bounds, margin_mm)
+            fixedImage = sitk.Cast(fixedImage, sitk.sitkInt16 if pixelType == 'short' else sitk.sitkFloat32)
+            maskImage = sitk.Cast(maskImage, sitk.sitkUInt8)
+            os.makedirs(cacheDir, exist_ok=True)
+            ## Write under a temporary name first, so an interrupted write never leaves a valid-looking entry
+            for image, path in ((fixedImage, fixedPath), (maskImage, maskPath)):
+                sitk.WriteImage(image, path + '.part.mha', False)
+                os.replace(path + '.part.mha', path)
+            logging.info("Prepared fixed registration inputs in %.2f s, cached at %s" % (time.perf_counter() - start, cacheDir))
+        entry = (fixedImage, maskImage, fixedPath, maskPath, ABLTemporalBoneSegmentationModuleLogic.get_mask_physical_bounds(maskImage))
+        ABLTemporalBoneSegmentationModuleLogic.fixedInputCache[key] = entry
+        return entry
+
+    @staticmethod
+    def write_elastix_initial_transform(path, fixed_image, rotation, translation):
+        """Write an Euler transform parameter file for Elastix's ``-t0``, rotating about the fixed image's center.
+
+        :param rotation: The rotation angles around x, y and z, in radians.
+        :param translation: The translation in mm (LPS).
+        """
+        center = fixed_image.TransformContinuousIndexToPhysicalPoint([(n - 1)/2 for n in fixed_image.GetSize()])
+        lines = [
+            '(Transform "EulerTransform")',
+            '(NumberOfParameters 6)',
+            '(TransformParameters %s)' % ' '.join('%.10f' % v for v in list(rotation) + list(translation)),
+            '(InitialTransformParametersFileName "NoInitialTransform")',
+            '(HowToCombineTransforms "Compose")',
+            '(FixedImageDimension 3)',
+            '(MovingImageDimension 3)',
+            '(FixedInternalImagePixelType "float")',
+            '(MovingInternalImagePixelType "float")',
+            '(Size %s)' % ' '.join(str(n) for n in fixed_image.GetSize()),
+            '(Index 0 0 0)',
+            '(Spacing %s)' % ' '.join('%.10f' % v for v in fixed_image.GetSpacing()),
+            '(Origin %s)' % ' '.join('%.10f' % v for v in fixed_image.GetOrigin()),
+            '(Direction %s)' % ' '.join('%.10f' % v for v in fixed_image.GetDirection()),
+            '(UseDirectionCosines "true")',
+            '(CenterOfRotationPoint %s)' % ' '.join('%.10f' % v for v in center),
+            '(ComputeZYX "false")',
+        ]
+        with open(path, 'w') as f: f.write('\n'.join(lines) + '\n')
+
+    @staticmethod
+    def create_multi_start_worker(elastix, args, temp_dir, fixed_image, starts, monitor_factory, rotation_sd=math.radians(10), translation_sd=2.0):
+        """Set up ``starts`` registrations sharing the inputs in ``temp_dir``, the first from the current
+        alignment and the others from random perturbations of it.
+
+        At most one start per core runs, and the cores are split evenly between the Elastix processes.
+        """
+        cores = os.cpu_count() or 1
+        starts = max(1, min(starts, cores))
+        rng = np.random.default_rng(0)
+        workers = []
+        for i in range(starts):
+            startDir = os.path.join(temp_dir, 'start-%d' % i)
+            os.makedirs(startDir)
+            initialPath = os.path.join(startDir, 'InitialTransform.txt')
+            rotation = np.zeros(3) if i == 0 else rng.normal(0, rotation_sd, 3)
+            translation = np.zeros(3) if i == 0 else rng.normal(0, translation_sd, 3)
+            ABLTemporalBoneSegmentationModuleLogic.write_elastix_initial_transform(initialPath, fixed_image, rotation, translation)
+            outIndex = args.index('-out')
+            startArgs = args[:outIndex + 1] + [startDir] + args[outIndex + 2:] + ['-t0', initialPath, '-threads', str(max(1, cores//starts))]
+            worker = ElastixWorker(elastix, startArgs, None, monitor_factory())
+            worker.resultDir = startDir
+            workers.append(worker)
+        return ElastixMultiStartWorker(workers, temp_dir)
+
+    @staticmethod
+    def get_registration_tier_parameter_file(tier):
+        """Get the parameter file of a registration tier from ``supportedRegistrationTiers``.
+
+        Tiers that override parameters get a derived file in the registration cache directory.
+
+        :return: A file name relative to Resources/Parameters, or an absolute path.
+        """
+        tier = next(t for t in supportedRegistrationTiers if t['value'] == tier)
+        if not tier['overrides']: return tier['file']
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        tierDir = ABLTemporalBoneSegmentationModuleLogic.get_registration_cache_dir('parameters')
+        os.makedirs(tierDir, exist_ok=True)
+        path = os.path.join(tierDir, os.path.splitext(tier['file'])[0] + '_' + tier['value'] + '.txt')
+        ABLTemporalBoneSegmentationModuleLogic.write_elastix_parameters(os.path.join(parametersDir, tier['file']), path, tier['overrides'])
+        return path
+
+    @staticmethod
+    def create_convergence_monitor(parameter_filename):
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        parameters = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(os.path.join(parametersDir, parameter_filename))
+        resolutions = int(parameters.get('NumberOfResolutions', ['1'])[0])
+        iterations = [int(i) for i in parameters.get('MaximumNumberOfIterations', ['500'])]
+        ## A single value applies to every resolution
+        iterations = (iterations*resolutions)[:resolutions] if len(iterations) == 1 else iterations[:resolutions]
+        return ElastixConvergenceMonitor(iterations)
+
+    @staticmethod
+    def start_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, parameter_filenames=("Parameters_Rigid.txt",), crop_margin_mm=None, use_cache=True, starts=1, threads=None):
+        """Write the registration inputs and start Elastix on a background worker.
+
+        The moving volume is registered as seen through its transforms. When a mask is given, the
+        registration only sees the mask's bounding box grown by ``crop_margin_mm`` (the
+        "abltbs_registration_crop_margin_mm" setting by default, negative to disable). Pass the
+        worker to ``finish_elastix_rigid_registration`` once it has stopped.
+
+        Results are cached on disk; with ``use_cache`` a previous result for the same inputs is
+        returned as an already finished worker with ``cached`` set.
+
+        With ``starts`` above 1, that many registrations from perturbed initial alignments run in
+        parallel and the one with the best final metric is kept. This always uses the executable.
+        ``threads`` limits the threads of a single-start Elastix run, e.g. when several run at once, on
+        either backend.
+
+        With the "abltbs_registration_early_stopping" setting, an executable run stops once its final
+        resolution plateaus. Earlier resolutions always run their full iterations.
+        """
+        elastix.abortRequested = False
+        if crop_margin_mm is None: crop_margin_mm = float(slicer.app.settings().value("abltbs_registration_crop_margin_mm", 5.0))
+        cacheKey = ABLTemporalBoneSegmentationModuleLogic.get_registration_result_key(atlas_node, moving_node, mask_node, parameter_filenames, crop_margin_mm, starts)
+        cachePath = os.path.join(ABLTemporalBoneSegmentationModuleLogic.get_registration_cache_dir('results'), cacheKey + '.json')
+        if use_cache and os.path.exists(cachePath):
+            worker = ElastixWorker(elastix, None, None)
+            with open(cachePath) as f: worker.matrix = np.array(json.load(f)['matrix'])
+            worker.returnCode = 0
+            worker.cached = True
+            worker.log.put('Registration is completed (cached result)')
+            logging.info("Reusing cached registration result " + cachePath)
+            return worker
+        registered_node = moving_node
+        if moving_node.GetParentTransformNode() is not None:
+            registered_node = ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(moving_node)
+        try:
+            movingImage = sitku.PullVolumeFromSlicer(registered_node.GetID())
+        finally:
+            if registered_node is not moving_node: slicer.mrmlScene.RemoveNode(registered_node)
+        maskImage = maskPath = None
+        if mask_node is not None:
+            fixedImage, maskImage, fixedPath, maskPath, bounds = ABLTemporalBoneSegmentationModuleLogic.get_fixed_registration_inputs(atlas_node, mask_node, crop_margin_mm, parameter_filenames)
+            ## Cropping the moving image to the mask assumes it is already roughly aligned with the atlas, as
+            ## it is after the fiducial or coarse initialization; otherwise it is registered whole
+            if bounds is not None and crop_margin_mm >= 0 and (moving_node.GetParentTransformNode() is None or starts > 1 or
+                    ABLTemporalBoneSegmentationModuleLogic.get_physical_bounds_overlap(movingImage, *bounds, 2*crop_margin_mm) < 0.5):
+                logging.info("Registering the whole moving image, which is not initialized or does not cover the mask")
+            elif bounds is not None and crop_margin_mm >= 0:
+                ## The moving image gets twice the margin, since it is not aligned with the mask yet
+                voxels = movingImage.GetNumberOfPixels()
+                movingImage = ABLTemporalBoneSegmentationModuleLogic.crop_image_to_physical_bounds(movingImage, *bounds, 2*crop_margin_mm)
+                logging.info("Registering on mask-bounded crops: fixed %d voxels, moving %d -> %d voxels" % (fixedImage.GetNumberOfPixels(), voxels, movingImage.GetNumberOfPixels()))
+        else:
+            fixedImage = fixedPath = sitku.PullVolumeFromSlicer(atlas_node.GetID())
+
+        backend = ABLTemporalBoneSegmentationModuleLogic.get_elastix_memory_backend()
+        start = time.perf_counter()
+        if backend is not None and starts <= 1:
+            ioBytes = ABLTemporalBoneSegmentationModuleLogic.estimate_elastix_io_bytes(fixedImage, movingImage, maskImage, maskImage)
+            parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+            worker = ElastixMemoryWorker(backend, fixedImage, movingImage, maskImage, maskImage, [os.path.join(parametersDir, f) for f in parameter_filenames], threads)
+            logging.info("Registering in memory with %s, skipping an estimated %.1f MB of temporary files" % (backend, ioBytes/2**20))
+        else:
+            earlyStopping = slicer.app.settings().value("abltbs_registration_early_stopping", "true") == "true"
+            create_monitor = lambda: ABLTemporalBoneSegmentationModuleLogic.create_convergence_monitor(parameter_filenames[-1]) if earlyStopping else None
+            tempDir, args = ABLTemporalBoneSegmentationModuleLogic.prepare_elastix_registration(elastix, fixedPath, movingImage, maskPath, maskPath, parameter_filenames, write_iterations=earlyStopping)
+            if starts > 1:
+                worker = ABLTemporalBoneSegmentationModuleLogic.create_multi_start_worker(elastix, args, tempDir, fixedImage, starts, create_monitor)
+            else:
+                if threads is not None: args += ['-threads', str(threads)]
+                worker = ElastixWorker(elastix, args, tempDir, create_monitor())
+            ioBytes = ABLTemporalBoneSegmentationModuleLogic.get_directory_bytes(tempDir)
+            logging.info("Wrote %.1f MB of Elastix inputs in %.2f s" % (ioBytes/2**20, time.perf_counter() - start))
+        worker.cacheKey = cacheKey
+        worker.start()
+        return worker
+
+    @staticmethod
+    def finish_elastix_rigid_registration(elastix, worker, name):
+        """Load the result of a finished registration worker as a linear transform node.
+
+        :return: A linear transform node taking the moving volume's world space to the atlas.
+        """
+        try:
+            if worker.abortRequested.is_set(): raise ValueError("User requested cancel.")
+            if worker.error is not None: raise worker.error
+            if worker.returnCode != 0 and not worker.stoppedEarly: raise RuntimeError("Elastix exited with code %s" % worker.returnCode)
+            matrix = worker.matrix
+            if worker.stoppedEarly:
+                ## Use the parameters of the last completed iteration of the final resolution
+                pattern = os.path.join(worker.resultDir, 'TransformParameters.%d.R%d.It*.txt' % (worker.args.count('-p') - 1, worker.monitor.resolution))
+                iterationFiles = sorted(glob.glob(pattern), key=lambda path: int(re.search(r'It(\d+)', os.path.basename(path)).group(1)))
+                ## Elastix may have been killed while writing the last file, so fall back to earlier ones
+                matrix = None
+                for path in reversed(iterationFiles):
+                    try:
+                        matrix = ABLTemporalBoneSegmentationModuleLogic.read_elastix_transform(path)
+                        break
+                    except (OSError, KeyError, ValueError, IndexError):
+                        logging.info("Skipping incomplete iteration result " + os.path.basename(path))
+                if matrix is None: raise RuntimeError("No complete iteration results found in " + worker.resultDir)
+                logging.info("Stopped registration early at iteration %d of resolution %d (%.0f%% of the maximum iterations)" % (
+                    worker.monitor.iteration, worker.monitor.resolution, 100*worker.monitor.progress))
+            elif matrix is None:
+                matrix = ABLTemporalBoneSegmentationModuleLogic.read_elastix_transform(os.path.join(worker.resultDir, 'TransformParameters.%d.txt' % (worker.args.count('-p') - 1)))
+            if worker.cacheKey is not None:
+                cacheDir = ABLTemporalBoneSegmentationModuleLogic.get_registration_cache_dir('results')
+                os.makedirs(cacheDir, exist_ok=True)
+                with open(os.path.join(cacheDir, worker.cacheKey + '.json'), 'w') as f:
+                    json.dump({'name': name, 'created': time.time(), 'matrix': np.asarray(matrix).tolist()}, f)
+            ## Elastix's transform maps atlas points to moving points in LPS, which is Slicer's transform
+            ## from parent once converted to RAS
+            lpsToRAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+            transform_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name + ' Elastix transform')
+            transform_node.SetMatrixTransformFromParent(slicer.util.vtkMatrixFromArray(lpsToRAS @ matrix @ lpsToRAS))
+            logging.debug("Elastix transform generated: %s" % transform_node.GetID())
+            return transform_node
+        finally:
+            if worker.tempDir is not None:
+                logging.info("Elastix temporary files took %.1f MB" % (ABLTemporalBoneSegmentationModuleLogic.get_directory_bytes(worker.tempDir)/2**20))
+                if elastix.deleteTemporaryFiles: shutil.rmtree(worker.tempDir, ignore_errors=True)
+
+    @staticmethod
+    def compute_elastix_rigid_transform(elastix, atlas_node, moving_node, mask_node, log_callback, starts=1, parameter_filenames=("Parameters_Rigid.txt",)):
+        """Register the moving volume (as seen through its transforms) to the atlas, waiting for the result.
+
+        :return: A linear transform node taking the moving volume's world space to the atlas.
+        """
+        worker = ABLTemporalBoneSegmentationModuleLogic.start_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, parameter_filenames=parameter_filenames, starts=starts)
+        while (worker.is_alive() and not worker.abortRequested.is_set()) or not worker.log.empty():
+            try: log_callback(worker.log.get(timeout=0.05))
+            except queue.Empty: pass
+            if elastix.abortRequested: worker.abort()
+        return ABLTemporalBoneSegmentationModuleLogic.finish_elastix_rigid_registration(elastix, worker, moving_node.GetName())
+
+    @staticmethod
+    def get_coarse_grid(image, grid_size):
+        """Resample an image onto an axis-aligned isotropic grid with at most ``grid_size`` voxels per side."""
+        size = np.array(image.GetSize())
+        corners = np.array([image.TransformIndexToPhysicalPoint((int(i), int(j), int(k)))
+                            for i in (0, size[0] - 1) for j in (0, size[1] - 1) for k in (0, size[2] - 1)])
+        lower, upper = corners.min(axis=0), corners.max(axis=0)
+        spacing = (upper - lower).max() / (grid_size - 1)
+        reference = sitk.Image([int(n) for n in np.floor((upper - lower) / spacing) + 1], sitk.sitkFloat32)
+        reference.SetOrigin(tuple(lower))
+        reference.SetSpacing([spacing]*3)
+        ## Smooth before decimating so the coarse grid does not alias
+        sigma = max(0.0, spacing/2 - min(image.GetSpacing()))
+        smoothed = sitk.SmoothingRecursiveGaussian(sitk.Cast(image, sitk.sitkFloat32), sigma) if sigma > 0 else sitk.Cast(image, sitk.sitkFloat32)
+        return sitk.Resample(smoothed, reference, sitk.Transform(), sitk.sitkLinear, float(np.min(sitk.GetArrayViewFromImage(image))))
+
+    @staticmethod
+    def get_image_moments(image):
+        """Get the centroid and principal axes (as columns, largest variance first) of an image's bright
+        structures, in physical coordinates."""
+        array = sitk.GetArrayViewFromImage(image)
+        ## Bone is what both scans share; weight by intensity above the upper quartile
+        weights = np.clip(array - np.percentile(array, 75), 0, None).ravel()
+        k, j, i = np.indices(array.shape).reshape(3, -1)
+        points = np.stack([i, j, k], axis=1)*np.array(image.GetSpacing()) + np.array(image.GetOrigin())
+        centroid = weights @ points / weights.sum()
+        centered = points - centroid
+        covariance = (centered*weights[:, None]).T @ centered / weights.sum()
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        return centroid, eigenvectors[:, ::-1]
+
+    @staticmethod
+    def compute_coarse_alignment(fixed_image, moving_image, grid_size=64):
+        """Find a coarse rigid alignment of two images without landmarks.
+
+        Candidate rotations come from matching the principal axes of the two images (each axis sign
+        combination with a proper rotation, plus no rotation at all). For each candidate, the
+        translation is refined by FFT phase correlation on downsampled copies, and the candidate with
+        the best normalized cross-correlation wins.
+
+        :return: A 4x4 matrix mapping fixed points to moving points in LPS, as Elastix does, and its
+            normalized cross-correlation.
+        """
+        fixed = ABLTemporalBoneSegmentationModuleLogic.get_coarse_grid(fixed_image, grid_size)
+        moving = ABLTemporalBoneSegmentationModuleLogic.get_coarse_grid(moving_image, grid_size)
+        fixedCentroid, fixedAxes = ABLTemporalBoneSegmentationModuleLogic.get_image_moments(fixed)
+        movingCentroid, movingAxes = ABLTemporalBoneSegmentationModuleLogic.get_image_moments(moving)
+        fixedArray = sitk.GetArrayFromImage(fixed)
+        fixedSpectrum = np.fft.rfftn(fixedArray - fixedArray.mean())
+        background = float(np.min(sitk.GetArrayViewFromImage(moving)))
+
+        rotations = [np.eye(3)]
+        for signs in itertools.product((1, -1), repeat=3):
+            rotation = movingAxes @ np.diag(signs) @ fixedAxes.T
+            if np.linalg.det(rotation) > 0: rotations.append(rotation)
+        best = (None, -np.inf)
+        for rotation in rotations:
+            matrix = np.eye(4)
+            matrix[:3, :3] = rotation
+            matrix[:3, 3] = movingCentroid - rotation @ fixedCentroid
+            resampled = ABLTemporalBoneSegmentationModuleLogic.resample_with_matrix(moving, fixed, matrix, background)
+            ## The peak of the phase correlation is the voxel shift taking the fixed grid onto the resampled moving one
+            crossPower = fixedSpectrum*np.conj(np.fft.rfftn(resampled - resampled.mean()))
+            correlation = np.fft.irfftn(crossPower/(np.abs(crossPower) + 1e-12), s=fixedArray.shape)
+            peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape))
+            peak = np.where(peak > np.array(correlation.shape)//2, peak - np.array(correlation.shape), peak)
+            shift = -peak[::-1]*np.array(fixed.GetSpacing())
+            matrix[:3, 3] += rotation @ shift
+            resampled = ABLTemporalBoneSegmentationModuleLogic.resample_with_matrix(moving, fixed, matrix, background)
+            a, b = fixedArray - fixedArray.mean(), resampled - resampled.mean()
+            score = float((a*b).sum() / (np.sqrt((a*a).sum()*(b*b).sum()) + 1e-12))
+            if score > best[1]: best = (matrix, score)
+        return best
+
+    @staticmethod
+    def resample_with_matrix(image, reference, matrix, default_value):
+        transform = sitk.AffineTransform(3)
+        transform.SetMatrix(tuple(matrix[:3, :3].ravel()))
+        transform.SetTranslation(tuple(matrix[:3, 3]))
+        return sitk.GetArrayFromImage(sitk.Resample(image, reference, transform, sitk.sitkLinear, default_value))
+
+    @staticmethod
+    def apply_coarse_alignment(atlas_node, moving_node):
+        """Coarsely align the moving volume (as seen through its transforms) to the atlas, adding the
+        result to its transform chain so that the rigid registration starts from it.
+
+        :return: The new transform node and the alignment's normalized cross-correlation.
+        """
+        start = time.perf_counter()
+        registered_node = moving_node
+        if moving_node.GetParentTransformNode() is not None:
+            registered_node = ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(moving_node)
+        try:
+            movingImage = sitku.PullVolumeFromSlicer(registered_node.GetID())
+        finally:
+            if registered_node is not moving_node: slicer.mrmlScene.RemoveNode(registered_node)
+        matrix, score = ABLTemporalBoneSegmentationModuleLogic.compute_coarse_alignment(sitku.PullVolumeFromSlicer(atlas_node.GetID()), movingImage)
+        lpsToRAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+        transform_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", moving_node.GetName() + ' coarse transform')
+        transform_node.SetMatrixTransformFromParent(slicer.util.vtkMatrixFromArray(lpsToRAS @ matrix @ lpsToRAS))
+        ABLTemporalBoneSegmentationModuleLogic.append_transform(moving_node, transform_node)
+        logging.info("Coarse alignment of %s in %.2f s (NCC %.3f)" % (moving_node.GetName(), time.perf_counter() - start, score))
+        return transform_node, score
+
+    @staticmethod
+    def apply_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback, copy=True, starts=1, parameter_filenames=("Parameters_Rigid.txt",)):
+        """Rigidly register the moving volume to the atlas and harden the result.
+
+        :param starts: The number of parallel registrations from perturbed initial alignments; the
+            one with the best final Mattes mutual information is kept.
+        :return: The registered volume, a copy of the moving volume if ``copy`` is set.
+        """
         outputVolumeNode = moving_node
         if copy:
             outputVolumeNode = slicer.vtkMRMLScalarVolumeNode()
             outputVolumeNode.Copy(moving_node)
             outputVolumeNode.SetName(moving_node.GetName() + "_Elastix")
-        transform_node = slicer.vtkMRMLTransformNode()
-        transform_node.SetName(moving_node.GetName() + ' Elastix transform')
-        slicer.mrmlScene.AddNode(transform_node)
-        elastix.registrationParameterFilesDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
-        elastix.logStandardOutput = True
-        elastix.logCallback = log_callback
-        elastix.registerVolumes(
-            fixedVolumeNode=atlas_node,
-            movingVolumeNode=moving_node,
-            parameterFilenames={"Parameters_Rigid.txt"},
-            # outputVolumeNode=outputVolumeNode,
-            outputTransformNode=transform_node,
-            fixedVolumeMaskNode=mask_node,
-            movingVolumeMaskNode=mask_node
-        )
-        print('TRANSFORM GENERATED: '); print(transform_node)
+        transform_node = ABLTemporalBoneSegmentationModuleLogic.compute_elastix_rigid_transform(elastix, atlas_node, moving_node, mask_node, log_callback, starts=starts, parameter_filenames=parameter_filenames)
+        ## The transform is linear, so hardening it only updates the volume's geometry
         outputVolumeNode.ApplyTransform(transform_node.GetTransformToParent())
         outputVolumeNode.HardenTransform()
         outputVolumeNode.SetName(moving_node.GetName() + "_Elastix")
         slicer.mrmlScene.AddNode(outputVolumeNode)
         return outputVolumeNode
 
+    @staticmethod
+    def benchmark_registration_parameters(elastix, atlas_node, mask_node, fiducial_node, sweep, base_parameter_filename="Parameters_Rigid.txt",
+                                          cases=3, rotation_sd=math.radians(5), translation_sd=2.0, crop_margin_mm=5.0, output_path=None):
+        """Measure the speed and accuracy of rigid registration parameter sets on synthetic cases.
+
+        Each case is the atlas moved by a random rigid transform, so the ground truth is known. Every
+        combination of the swept parameters is run on every case through the Elastix executable.
+        This can take hours; run it from the Python console. For example::
+
+            logic.benchmark_registration_parameters(elastix, atlas, mask, fiducials, {
+                "NumberOfSpatialSamples": [512, 2048], "NumberOfResolutions": [2, 3, 4],
+                "MaximumNumberOfIterations": [100, 250], "NumberOfHistogramBins": [16, 32]})
+
+        :param sweep: The values to try for each Elastix parameter, overriding the base parameter file.
+        :param fiducial_node: The atlas fiducials, where the target registration error (TRE) is measured.
+        :param output_path: A CSV file to write the results to.
+        :return: One row per parameter combination, with the mean and maximum wall time, peak Elastix
+            memory and TRE over all cases, and whether the row is on the time/TRE Pareto front.
+        """
+        parametersDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+        fixedImage, maskImage, fixedPath, maskPath, bounds = ABLTemporalBoneSegmentationModuleLogic.get_fixed_registration_inputs(atlas_node, mask_node, crop_margin_mm, (base_parameter_filename,))
+        atlasImage = sitku.PullVolumeFromSlicer(atlas_node.GetID())
+        lpsToRAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+        targets = np.array([lpsToRAS[:3, :3] @ p for p in ABLTemporalBoneSegmentationModuleLogic.get_fiducial_positions(fiducial_node).values()])
+        center = atlasImage.TransformContinuousIndexToPhysicalPoint([(n - 1)/2 for n in atlasImage.GetSize()])
+
+        benchmarkDir = tempfile.mkdtemp(prefix='ABLBenchmark_', dir=elastix.getTempDirectoryBase())
+        rng = np.random.default_rng(0)
+        movingPaths, truths = [], []
+        for i in range(cases):
+            ## The moving image samples the atlas through the transform, so registration should find exactly it
+            truth = sitk.Euler3DTransform(center, *rng.normal(0, rotation_sd, 3), tuple(rng.normal(0, translation_sd, 3)))
+            moving = sitk.Resample(atlasImage, atlasImage, truth.GetInverse(), sitk.sitkLinear, 0.0)
+            if bounds is not None: moving = ABLTemporalBoneSegmentationModuleLogic.crop_image_to_physical_bounds(moving, *bounds, 2*crop_margin_mm)
+            movingPaths.append(os.path.join(benchmarkDir, 'moving%d.mha' % i))
+            sitk.WriteImage(moving, movingPaths[-1], False)
+            truths.append(np.array([truth.TransformPoint(tuple(p)) for p in targets]))
+
+        names = list(sweep.keys())
+        rows = []
+        for values in itertools.product(*(sweep[n] for n in names)):
+            overrides = dict(zip(names, values))
+            parameterPath = os.path.join(benchmarkDir, 'Parameters.txt')
+            ABLTemporalBoneSegmentationModuleLogic.write_elastix_parameters(os.path.join(parametersDir, base_parameter_filename), parameterPath, overrides)
+            times, memories, errors = [], [], []
+            for movingPath, truth in zip(movingPaths, truths):
+                resultDir = os.path.join(benchmarkDir, 'result')
+                shutil.rmtree(resultDir, ignore_errors=True)
+                os.makedirs(resultDir)
+                worker = ElastixWorker(elastix, ['-f', fixedPath, '-m', movingPath, '-fMask', maskPath, '-mMask', maskPath, '-out', resultDir, '-p', parameterPath], benchmarkDir)
+                start = time.perf_counter()
+                worker.run()
+                times.append(time.perf_counter() - start)
+                if worker.error is not None or worker.returnCode != 0:
+                    logging.warning("Benchmark run %s failed: %s" % (overrides, worker.error or worker.returnCode))
+                    continue
+                matrix = ABLTemporalBoneSegmentationModuleLogic.read_elastix_transform(os.path.join(resultDir, 'TransformParameters.0.txt'))
+                mapped = targets @ matrix[:3, :3].T + matrix[:3, 3]
+                memories.append(worker.peakMemory or 0)
+                errors.append(np.linalg.norm(mapped - truth, axis=1).mean())
+            if not errors: continue
+            rows.append(dict(overrides, seconds=np.mean(times), max_seconds=np.max(times), peak_mb=np.max(memories)/2**20,
+                             tre_mm=np.mean(errors), max_tre_mm=np.max(errors)))
+        shutil.rmtree(benchmarkDir, ignore_errors=True)
+
+        for row in rows:
+            row['pareto'] = not any(o['seconds'] <= row['seconds'] and o['tre_mm'] <= row['tre_mm'] and (o['seconds'], o['tre_mm']) != (row['seconds'], row['tre_mm']) for o in rows)
+        rows.sort(key=lambda r: r['seconds'])
+        columns = names + ['seconds', 'max_seconds', 'peak_mb', 'tre_mm', 'max_tre_mm', 'pareto']
+        if output_path is not None:
+            with open(output_path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(rows)
+        table = [' | '.join(columns)] + [' | '.join(('%.3f' % r[c]) if isinstance(r[c], float) else str(r[c]) for c in columns) for r in rows]
+        logging.info("Registration benchmark (%d cases):\n" % cases + '\n'.join(table))
+        return rows
+
     @staticmethod
     def process_rigid_progress(text):
         progress = None
@@ -1343,8 +3076,9 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         return progress
 
     @staticmethod
-    def attempt_abort_rigid_registration(elastix):
+    def attempt_abort_rigid_registration(elastix, worker=None):
         elastix.abortRequested = True
+        if worker is not None: worker.abort()
 
     @staticmethod
     def open_save_node_dialog(node):
@@ -1357,13 +3091,21 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         dialog.selectFile(name)
         dialog.setAcceptMode(qt.QFileDialog.AcceptSave)
         if dialog.exec_() != qt.QDialog.Accepted: return
-        o = slicer.util.saveNode(node=node, filename=dialog.selectedFiles()[0] + next(t for t in supportedSaveTypes if t["title"] == dialog.selectedNameFilter())['value'])
+        ## Volumes are written without their parent transforms, so save a copy of the geometry with them folded in
+        saved = node
+        if node.GetParentTransformNode() is not None: saved = ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(node, name=name)
+        try:
+            o = slicer.util.saveNode(node=saved, filename=dialog.selectedFiles()[0] + next(t for t in supportedSaveTypes if t["title"] == dialog.selectedNameFilter())['value'])
+        finally:
+            if saved is not node: slicer.mrmlScene.RemoveNode(saved)
 
     @staticmethod
-    def run_inference(config, model, model_config, dispatch=SlicerDispatchDocker, progress=lambda *args: None, get_model=False):
+    def run_inference(config, model, model_config, dispatch=None, progress=lambda *args: None, get_model=False):
+        ablinfer = import_ablinfer()
+        if dispatch is None: dispatch = ablinfer.slicer.SlicerDispatchDocker
         dispatch = dispatch(config)
 
-        if get_model and isinstance(dispatch, DispatchRemote): ## Try to retrieve the model from the remote server
+        if get_model and isinstance(dispatch, ablinfer.remote.DispatchRemote): ## Try to retrieve the model from the remote server
             try:
                 model = dispatch.get_model(model["id"])
             except Exception as e:
@@ -1454,3 +3196,7 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
 
         ## Clean up the labelmap
         slicer.mrmlScene.RemoveNode(labelmap)
+
+
+moduleImportSeconds = time.perf_counter() - importStartTime
+logging.debug("ABLTemporalBoneSegmentationModule imported in %.1f ms" % (moduleImportSeconds*1000))
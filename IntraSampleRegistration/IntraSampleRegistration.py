@@ -1,7 +1,22 @@
+import time
+
+importStartTime = time.perf_counter()
+
+import collections
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import traceback
+import ctk
+import numpy as np
 import qt
 import slicer
+import vtk
 import ABLTemporalBoneSegmentationModule
-import Elastix
 from slicer.ScriptedLoadableModule import *
 
 
@@ -45,6 +60,30 @@ class RegistrationType:
     CUSTOM_BRAINS = 2
 
 
+class RegistrationStep:
+    def __init__(self, registration_type):
+        self.type = registration_type
+        self.tierBox = None
+        if registration_type is RegistrationType.CUSTOM_ELASTIX:
+            self.tierBox = qt.QComboBox()
+            for i in ABLTemporalBoneSegmentationModule.supportedRegistrationTiers: self.tierBox.addItem(i["title"])
+            self.tierBox.currentIndex = 1
+
+    def disable(self):
+        if self.tierBox is not None: self.tierBox.enabled = False
+
+    def enable(self):
+        if self.tierBox is not None: self.tierBox.enabled = True
+
+    def tier(self):
+        return ABLTemporalBoneSegmentationModule.supportedRegistrationTiers[self.tierBox.currentIndex]["value"]
+
+    def TitleString(self):
+        if self.type is RegistrationType.CUSTOM_ELASTIX: return 'Custom Elastix Registration'
+        elif self.type is RegistrationType.CUSTOM_BRAINS: return 'Custom BRAINS Registration'
+        return ''
+
+
 class PairStatus:
     LOADING = 1
     READY = 2
@@ -55,10 +94,16 @@ class PairStatus:
 
 
 class Pair:
-    def __init__(self, on_click):
+    """A fixed and a moving volume, picked from the scene or, with ``fixed_path`` and ``moving_path``, left
+    on disk until the pair runs."""
+    def __init__(self, on_click, fixed_path=None, moving_path=None):
         self.fixed = InterfaceTools.build_volume_selector(on_click)
         self.moving = InterfaceTools.build_volume_selector(on_click)
+        self.fixedPath = fixed_path
+        self.movingPath = moving_path
         self.status = PairStatus.LOADING
+        self.estimatedMemory = None
+        self.peakMemory = None
 
     def disable(self):
         self.fixed.enabled = self.moving.enabled = False
@@ -66,7 +111,18 @@ class Pair:
     def enable(self):
         self.fixed.enabled = self.moving.enabled = True
 
+    def is_file_pair(self):
+        return self.fixedPath is not None
+
+    def fixed_source(self):
+        return self.fixedPath if self.is_file_pair() else self.fixed.currentNode()
+
+    def moving_source(self):
+        return self.movingPath if self.is_file_pair() else self.moving.currentNode()
+
     def StatusString(self):
+        if self.status == PairStatus.LOADING and self.is_file_pair():
+            return str(os.path.isfile(self.fixedPath) + os.path.isfile(self.movingPath)) + "/2"
         if self.status == PairStatus.LOADING:
             n = 1 if self.fixed.currentNode() is not None else 0
             n += 1 if self.moving.currentNode() is not None else 0
@@ -78,6 +134,12 @@ class Pair:
         elif self.status == PairStatus.FAILED: return "Failed"
         return "0"
 
+    def MemoryString(self):
+        if self.estimatedMemory is None: return ""
+        string = "%.1f GB" % (self.estimatedMemory/2**30)
+        if self.peakMemory is not None: string += " / %.1f GB" % (self.peakMemory/2**30)
+        return string
+
 
 class IntraSampleRegistration(ScriptedLoadableModule):
     def __init__(self, parent):
@@ -97,15 +159,31 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
     volumePairs = []
 
     # Registration logic nodes
-    elastixLogic = Elastix.ElastixLogic()
-    brainsCliLogic = None
+    _elastixLogic = None
+    batchScheduler = None
+
+    # Progress updates, coalesced and applied at most every progressInterval ms
+    progressInterval = 200
+    progressTimer = None
+    pendingProgress = {}
+    changedPairs = set()
+    pairRows = {}
+    pairStatuses = {}
+    statusCounts = collections.Counter()
 
     # UI members -------------- (in order of appearance)
     processTable = None
     processTools = None
+    parallelPairsBox = None
+    coresBox = None
+    memoryLimitBox = None
     volumeTable = None
     volumePairTools = None
     addButton = None
+    addDirectoriesButton = None
+    addManifestButton = None
+    patternEdit = None
+    outputDirectoryEdit = None
     removeButton = None
     executeButton = None
     saveButton = None
@@ -120,21 +198,34 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
     def __init__(self, parent):
         ScriptedLoadableModuleWidget.__init__(self, parent)
 
+    @property
+    def elastixLogic(self):
+        ## Importing Elastix is deferred until a registration needs it
+        if self._elastixLogic is None:
+            self._elastixLogic = ABLTemporalBoneSegmentationModule.import_deferred('Elastix').ElastixLogic()
+        return self._elastixLogic
+
     # UI build ------------------------------------------------------------------------------
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
         self.layout.addLayout(self.build_process_setup())
         self.layout.addLayout(self.build_volume_pair_table())
         self.layout.addWidget(self.build_volume_pair_tools())
+        self.layout.addLayout(self.build_batch_source())
         self.layout.addWidget(self.build_progress())
+        self.progressTimer = qt.QTimer()
+        self.progressTimer.setSingleShot(True)
+        self.progressTimer.setInterval(self.progressInterval)
+        self.progressTimer.connect('timeout()', self.apply_progress)
         self.click_add_volume_pair()
 
     def build_process_setup(self):
-        self.processTable = qt.QTableWidget(0, 1)
+        self.processTable = qt.QTableWidget(0, 2)
         self.processTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
         self.processTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
         self.processTable.horizontalHeader().hide()
         self.processTable.horizontalHeader().setSectionResizeMode(0, qt.QHeaderView.Stretch)
+        self.processTable.setColumnWidth(1, 120)
         self.processTable.setSizePolicy(qt.QSizePolicy.Minimum, qt.QSizePolicy.Minimum)
         self.processTable.setMaximumHeight(70)
 
@@ -160,21 +251,44 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         box.addWidget(b)
         box.setContentsMargins(0, 0, 0, 0)
 
+        self.parallelPairsBox = qt.QSpinBox()
+        self.parallelPairsBox.setMinimum(1)
+        self.parallelPairsBox.setMaximum(max(1, os.cpu_count() or 1))
+        self.parallelPairsBox.value = max(1, min(4, (os.cpu_count() or 1)//2))
+        self.parallelPairsBox.setToolTip("Largest number of pairs registered at the same time. The cores are shared between them.")
+        self.coresBox = qt.QSpinBox()
+        self.coresBox.setMinimum(1)
+        self.coresBox.setMaximum(max(1, os.cpu_count() or 1))
+        self.coresBox.value = max(1, os.cpu_count() or 1)
+        self.coresBox.setToolTip("Number of cores shared by the registrations running at the same time.")
+        self.memoryLimitBox = qt.QDoubleSpinBox()
+        self.memoryLimitBox.setSuffix(" GB")
+        self.memoryLimitBox.setDecimals(1)
+        self.memoryLimitBox.setMinimum(0.5)
+        self.memoryLimitBox.setMaximum(IntraSampleRegistrationLogic.get_physical_memory()/2**30)
+        self.memoryLimitBox.value = float(slicer.app.settings().value("abltbs_batch_memory_limit_gb", 0.75*IntraSampleRegistrationLogic.get_physical_memory()/2**30))
+        self.memoryLimitBox.setToolTip("Pairs only start while the estimated memory of the running registrations stays below this.")
+
         layout = qt.QFormLayout()
         layout.addRow("Registration Steps:", self.processTable)
         layout.addWidget(self.processTools)
+        layout.addRow("Parallel Pairs:", self.parallelPairsBox)
+        layout.addRow("Cores:", self.coresBox)
+        layout.addRow("Memory Limit:", self.memoryLimitBox)
         layout.setMargin(10)
         return layout
 
     def build_volume_pair_table(self):
-        self.volumeTable = qt.QTableWidget(0, 3)
+        self.volumeTable = qt.QTableWidget(0, 4)
         self.volumeTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
-        self.volumeTable.setHorizontalHeaderLabels(["Fixed Volume", "Moving Volume", "Status"])
+        self.volumeTable.setHorizontalHeaderLabels(["Fixed Volume", "Moving Volume", "Status", "Memory"])
         self.volumeTable.verticalHeader().setFixedWidth(30)
         self.volumeTable.verticalHeader().setSectionResizeMode(qt.QHeaderView.Fixed)
         self.volumeTable.horizontalHeader().setSectionResizeMode(0, qt.QHeaderView.Stretch)
         self.volumeTable.horizontalHeader().setSectionResizeMode(1, qt.QHeaderView.Stretch)
         self.volumeTable.setColumnWidth(2, 70)
+        self.volumeTable.setColumnWidth(3, 110)
+        self.volumeTable.horizontalHeaderItem(3).setToolTip("Estimated / actual peak memory of the registrations")
         self.volumeTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
         self.volumeTable.connect('itemSelectionChanged()', self.update_selection)
         layout = qt.QVBoxLayout()
@@ -208,6 +322,27 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         layout.setContentsMargins(10, 0, 10, 20)
         return self.volumePairTools
 
+    def build_batch_source(self):
+        self.addDirectoriesButton = InterfaceTools.build_button("Add From Directories...", self.click_add_directories,
+            tooltip="Pair the files of a fixed and a moving directory whose names give the same match for the pattern")
+        self.addManifestButton = InterfaceTools.build_button("Add From Manifest...", self.click_add_manifest,
+            tooltip="Add the pairs of a CSV file with 'fixed' and 'moving' columns; relative paths start at the CSV's directory")
+        self.patternEdit = qt.QLineEdit(slicer.app.settings().value("abltbs_batch_pair_pattern", IntraSampleRegistrationLogic.defaultPairPattern))
+        self.patternEdit.setToolTip("Regular expression matched against file names; its first group (or the whole match) pairs the files")
+        self.outputDirectoryEdit = ctk.ctkPathLineEdit()
+        self.outputDirectoryEdit.filters = ctk.ctkPathLineEdit.Dirs
+        self.outputDirectoryEdit.setToolTip("Where moved volumes and transforms are written. Pairs added from disk are unloaded once written; "
+                                            "by default they are written next to the moving volume.")
+        row = qt.QHBoxLayout()
+        row.addWidget(self.addDirectoriesButton)
+        row.addWidget(self.addManifestButton)
+        layout = qt.QFormLayout()
+        layout.addRow(row)
+        layout.addRow("File Name Pattern:", self.patternEdit)
+        layout.addRow("Output Directory:", self.outputDirectoryEdit)
+        layout.setContentsMargins(10, 0, 10, 10)
+        return layout
+
     def build_progress(self):
         self.currentProgressLabel = qt.QLabel("Status:")
         self.currentlyRunningLabel = qt.QLabel("Parameters: Elastix Rigid Registration")
@@ -251,12 +386,10 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             self.processTools.hide()
 
     def update_process_table(self):
-        for i, pair in enumerate(self.registrationSteps):
+        for i, step in enumerate(self.registrationSteps):
             if self.processTable.item(i, 0) is None: self.processTable.setItem(i, 0, InterfaceTools.build_text_item())
-            text = ''
-            if self.registrationSteps[i] is RegistrationType.CUSTOM_ELASTIX: text = 'Custom Elastix Registration'
-            elif self.registrationSteps[i] is RegistrationType.CUSTOM_BRAINS: text = 'Custom BRAINS Registration'
-            self.processTable.item(i, 0).setText(text)
+            self.processTable.item(i, 0).setText(step.TitleString())
+            if step.tierBox is not None and self.processTable.cellWidget(i, 1) is None: self.processTable.setCellWidget(i, 1, step.tierBox)
 
     def update_volume_pair_tools(self):
         if self.state == IntraSampleRegistrationState.INPUT:
@@ -268,7 +401,7 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             self.executeButton.enabled = True if (toExecute > 0 and len(self.registrationSteps) > 0) else False
             selection = self.volumeTable.selectionModel().selectedRows()
             self.removeButton.enabled = True if len(selection) > 0 else False
-            self.saveButton.enabled = True if len(selection) == 1 and self.volumePairs[selection[0].row()].status == PairStatus.COMPLETE else False   # TODO add multi save
+            self.saveButton.enabled = True if len(selection) == 1 and self.volumePairs[selection[0].row()].status == PairStatus.COMPLETE and not self.volumePairs[selection[0].row()].is_file_pair() else False   # TODO add multi save
         elif self.state == IntraSampleRegistrationState.EXECUTION:
             self.volumePairTools.hide()
             self.progressBox.show()
@@ -284,16 +417,27 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             self.update_row(pair, i)
 
     def update_row_status(self, pair):
-        if self.state == IntraSampleRegistrationState.INPUT:
+        if self.state == IntraSampleRegistrationState.INPUT and pair.is_file_pair():
+            if not os.path.isfile(pair.fixedPath) or not os.path.isfile(pair.movingPath): pair.status = PairStatus.LOADING
+            elif pair.status is not PairStatus.COMPLETE: pair.status = PairStatus.READY
+        elif self.state == IntraSampleRegistrationState.INPUT:
             f, m = pair.fixed.currentNode(), pair.moving.currentNode()
             if f is None or m is None: pair.status = PairStatus.LOADING
             elif pair.status is not PairStatus.COMPLETE: pair.status = PairStatus.READY
 
     def update_row(self, pair, i):
-        self.volumeTable.setCellWidget(i, 0, pair.fixed)
-        self.volumeTable.setCellWidget(i, 1, pair.moving)
+        if pair.is_file_pair():
+            for column, path in ((0, pair.fixedPath), (1, pair.movingPath)):
+                if self.volumeTable.item(i, column) is None: self.volumeTable.setItem(i, column, InterfaceTools.build_text_item())
+                self.volumeTable.item(i, column).setText(os.path.basename(path))
+                self.volumeTable.item(i, column).setToolTip(path)
+        elif self.volumeTable.cellWidget(i, 0) is not pair.fixed:
+            self.volumeTable.setCellWidget(i, 0, pair.fixed)
+            self.volumeTable.setCellWidget(i, 1, pair.moving)
         if self.volumeTable.item(i, 2) is None: self.volumeTable.setItem(i, 2, InterfaceTools.build_text_item())
         self.volumeTable.item(i, 2).setText(pair.StatusString())
+        if self.volumeTable.item(i, 3) is None: self.volumeTable.setItem(i, 3, InterfaceTools.build_text_item())
+        self.volumeTable.item(i, 3).setText(pair.MemoryString())
 
     def update_selection(self):
         rows = self.volumeTable.selectionModel().selectedRows()
@@ -304,7 +448,29 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.update_slicer_view(f, m, 0.4)
         self.update_volume_pair_tools()
 
-    def update_progress(self, text=None, current_registration_step=None, progress=None):
+    def update_progress(self, text=None, current_registration_step=None, progress=None, immediate=False):
+        ## Only the latest of each value is kept until the next refresh, unless it is shown immediately
+        if text is not None: self.pendingProgress['text'] = text
+        if current_registration_step is not None: self.pendingProgress['step'] = current_registration_step
+        if progress is not None: self.pendingProgress['progress'] = progress
+        if immediate: self.apply_progress()
+        elif not self.progressTimer.isActive(): self.progressTimer.start()
+
+    def update_pair(self, pair):
+        """Record a change of a pair's status or memory, to be shown at the next refresh."""
+        previous = self.pairStatuses.get(pair)
+        if previous != pair.status:
+            if previous is not None: self.statusCounts[previous] -= 1
+            self.statusCounts[pair.status] += 1
+            self.pairStatuses[pair] = pair.status
+        self.changedPairs.add(pair)
+        if not self.progressTimer.isActive(): self.progressTimer.start()
+
+    def apply_progress(self):
+        self.progressTimer.stop()
+        update, self.pendingProgress = self.pendingProgress, {}
+        text, current_registration_step, progress = update.get('text'), update.get('step'), update.get('progress')
+        state = self.state
         if text is not None:
             print(text)
             self.currentProgressLabel.text = 'Status: ' + ((text[:60] + '..') if len(text) > 60 else text)
@@ -312,25 +478,27 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
 
         if progress is not None:
             self.progressBar.value = progress
-            executed = len([p for p in self.volumePairs if p.status in [PairStatus.EXECUTING, PairStatus.COMPLETE]])
-            total = len([p for p in self.volumePairs if p.status == PairStatus.PENDING]) + executed
+            executed = self.statusCounts[PairStatus.EXECUTING] + self.statusCounts[PairStatus.COMPLETE]
+            total = self.statusCounts[PairStatus.PENDING] + executed
             self.progressBar.setFormat(str(progress) + '% (' + str(executed) + ' of ' + str(total) + ')')
             if progress == 100:
                 self.state = IntraSampleRegistrationState.FINISHED
         if current_registration_step is not None and self.state is not IntraSampleRegistrationState.FINISHED:
             registration = None
-            if current_registration_step is RegistrationType.CUSTOM_ELASTIX: registration = 'Elastix'
-            elif current_registration_step is RegistrationType.CUSTOM_BRAINS: registration = 'BRAINS'
+            if current_registration_step.type is RegistrationType.CUSTOM_ELASTIX: registration = 'Elastix (' + current_registration_step.tierBox.currentText + ')'
+            elif current_registration_step.type is RegistrationType.CUSTOM_BRAINS: registration = 'BRAINS'
             self.currentlyRunningLabel.text = 'Executing ' + registration + '...'
         elif self.state is IntraSampleRegistrationState.FINISHED:
             self.currentlyRunningLabel.text = 'Execution complete...'
 
-        self.update_all()
-        slicer.app.processEvents()
+        for pair in self.changedPairs:
+            if pair in self.pairRows: self.update_row(pair, self.pairRows[pair])
+        self.changedPairs.clear()
+        if self.state is not state: self.update_volume_pair_tools()
 
     # button actions --------------------------------------
     def click_add_registration_step(self, process):
-        self.registrationSteps.append(process)
+        self.registrationSteps.append(RegistrationStep(process))
         self.processTable.insertRow(self.processTable.rowCount)
         self.update_all()
 
@@ -345,6 +513,36 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.volumeTable.insertRow(self.volumeTable.rowCount)
         self.update_all()
 
+    def add_file_pairs(self, paths):
+        for fixedPath, movingPath in paths:
+            self.volumePairs.append(Pair(on_click=self.update_all, fixed_path=fixedPath, moving_path=movingPath))
+            self.volumeTable.insertRow(self.volumeTable.rowCount)
+        self.update_all()
+
+    def click_add_directories(self):
+        fixedDirectory = qt.QFileDialog.getExistingDirectory(None, "Fixed Volume Directory")
+        if not fixedDirectory: return
+        movingDirectory = qt.QFileDialog.getExistingDirectory(None, "Moving Volume Directory", fixedDirectory)
+        if not movingDirectory: return
+        try:
+            paths = IntraSampleRegistrationLogic.match_directory_pairs(fixedDirectory, movingDirectory, self.patternEdit.text)
+        except re.error as e:
+            slicer.util.errorDisplay("Invalid file name pattern: " + str(e))
+            return
+        if not paths: slicer.util.warningDisplay("No file names in the two directories matched each other.")
+        slicer.app.settings().setValue("abltbs_batch_pair_pattern", self.patternEdit.text)
+        self.add_file_pairs(paths)
+
+    def click_add_manifest(self):
+        path = qt.QFileDialog.getOpenFileName(None, "Batch Manifest", "", "CSV (*.csv)")
+        if not path: return
+        try:
+            paths = IntraSampleRegistrationLogic.read_pair_manifest(path)
+        except (OSError, KeyError, csv.Error) as e:
+            slicer.util.errorDisplay("Could not read the manifest: " + str(e))
+            return
+        self.add_file_pairs(paths)
+
     def click_remove_volume_pair(self):
         for i in reversed(self.volumeTable.selectionModel().selectedRows()):
             del self.volumePairs[i.row()]
@@ -352,27 +550,40 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.update_all()
 
     def click_execute(self):
-        self.update_progress(progress=0)
-        self.state = IntraSampleRegistrationState.EXECUTION
         readyPairs = []
         # prep ready pairs
-        for pair in self.volumePairs:
+        self.pairRows, self.pairStatuses, self.statusCounts = {}, {}, collections.Counter()
+        self.changedPairs.clear()
+        for i, pair in enumerate(self.volumePairs):
             if pair.status == PairStatus.READY:
                 readyPairs.append(pair)
                 pair.status = PairStatus.PENDING
+                self.pairRows[pair] = i
+                self.update_pair(pair)
             pair.disable()
+        ## The scheduler estimates the pairs' memory, which the first refresh shows
+        self.batchScheduler = BatchScheduler(self.elastixLogic, readyPairs, self.registrationSteps, self.update_progress, self.parallelPairsBox.value,
+                                             cores=self.coresBox.value, memory_limit=int(self.memoryLimitBox.value*2**30),
+                                             output_directory=self.outputDirectoryEdit.currentPath or None, pair_changed=self.update_pair,
+                                             journal=BatchJournal(IntraSampleRegistrationLogic.get_journal_path(self.outputDirectoryEdit.currentPath)))
+        self.update_progress(progress=0, immediate=True)
+        self.state = IntraSampleRegistrationState.EXECUTION
+        for step in self.registrationSteps: step.disable()
         self.update_all()
         # execute
-        IntraSampleRegistrationLogic().execute_batch(self.elastixLogic, readyPairs, self.registrationSteps, self.update_progress)
+        self.batchScheduler.start()
 
     def click_cancel(self):
-        ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.elastixLogic)
-        if self.brainsCliLogic is not None: self.brainsCliLogic.Cancel()
+        if self.batchScheduler is not None: self.batchScheduler.cancel()
+        self.batchScheduler = None
+        self.progressTimer.stop()
+        self.pendingProgress = {}
         self.click_finish()
 
     def click_finish(self):
         self.state = IntraSampleRegistrationState.INPUT
         for pair in self.volumePairs: pair.enable()
+        for step in self.registrationSteps: step.enable()
         self.update_all()
 
     def click_save(self):
@@ -380,62 +591,454 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.open_save_node_dialog(self.volumePairs[i.row()].moving.currentNode())
 
 
+class BatchJournal:
+    """The completed registration steps of batch pairs, kept in a JSON file so that reruns skip them.
+
+    Entries are keyed by ``IntraSampleRegistrationLogic.get_pair_key`` and hold the pair's status, its
+    written outputs and, for each completed step, the step's key, suffix and transform (the 4x4 RAS
+    matrix to parent). A rerun resumes each pair after the steps that match its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f: self.entries = json.load(f)['pairs']
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning("Ignoring unreadable batch journal " + path + ": " + str(e))
+
+    def get_completed_steps(self, key, step_keys):
+        completed = []
+        for step, stepKey in zip(self.entries.get(key, {}).get('steps', []), step_keys):
+            if step['step'] != stepKey: break
+            completed.append(step)
+        return completed
+
+    def get_outputs(self, key, step_keys):
+        """Get the written outputs of a pair that completed all of ``step_keys``, if they are all still there."""
+        entry = self.entries.get(key, {})
+        if entry.get('status') != 'complete' or len(self.get_completed_steps(key, step_keys)) != len(step_keys): return None
+        outputs = entry.get('outputs') or []
+        return outputs if outputs and all(os.path.exists(path) for path in outputs) else None
+
+    def record_step(self, key, index, step_key, matrix, suffix):
+        entry = self.entries.setdefault(key, {'steps': []})
+        del entry['steps'][index:]
+        entry['steps'].append({'step': step_key, 'suffix': suffix, 'matrix': matrix.tolist()})
+        entry['status'] = 'executing'
+        self.write()
+
+    def record_status(self, key, status, outputs=None, error=None):
+        entry = self.entries.setdefault(key, {'steps': []})
+        entry.update(status=status, outputs=outputs or [], error=error, updated=time.time())
+        self.write()
+
+    def write(self):
+        ## Write a copy and swap it in, so that a crash never leaves a partial journal
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f: json.dump({'pairs': self.entries}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class BatchJob:
+    """The state of one pair's run through the registration steps.
+
+    Each step adds its transform to the output volume's transform chain; the chain is hardened once,
+    after the last step.
+    """
+    def __init__(self, pair, steps):
+        self.pair = pair
+        self.steps = steps
+        self.stepIndex = 0
+        self.outputNode = None
+        self.suffix = ''
+        self.transformNodes = []
+        self.worker = None  # ElastixWorker of the running Elastix step
+        self.cliNode = None  # BRAINSFit CLI node of the running BRAINS step
+        self.referenceNode = None
+        self.fixedNode = None
+        self.movingNode = None
+        self.loadedNodes = []  # nodes loaded from disk for this job, removed once it is over
+        self.key = None  # journal key
+        self.stepKeys = [IntraSampleRegistrationLogic.get_step_key(step) for step in steps]
+        self.text = None
+        self.stepProgress = 0
+        self.estimatedMemory = IntraSampleRegistrationLogic.estimate_job_memory(pair, steps)
+        pair.estimatedMemory = self.estimatedMemory
+        pair.peakMemory = None
+
+    def current_step(self):
+        return self.steps[self.stepIndex] if self.stepIndex < len(self.steps) else None
+
+    def progress(self):
+        return (self.stepIndex + self.stepProgress/100) / len(self.steps)
+
+
+class BatchScheduler:
+    """Runs the registration steps of up to ``max_running`` pairs at once, driven by a QTimer.
+
+    Elastix runs on ElastixWorker threads (each with its own temporary directory) and BRAINSFit runs as
+    an asynchronous CLI, so each tick only polls them and starts whatever can start; the GUI thread is
+    never blocked. ``update_progress`` receives the same arguments as the widget's method of that name,
+    and ``pair_changed`` is called with a pair whenever its status or memory changes.
+
+    Pairs start largest first, and only while the estimated memory of the running pairs stays under
+    ``memory_limit`` bytes; a pair too large for the limit still runs, alone. The ``cores`` are split
+    between the Elastix runs.
+
+    With an ``output_directory``, each moved volume and its transform are written there. Pairs of files
+    are only loaded when they start, always written out (next to the moving file by default), and
+    removed from the scene once done, so the scene holds no more than the running pairs.
+
+    With a ``journal`` (a ``BatchJournal``), each finished step and pair is recorded in it, and the steps
+    it already holds are replayed from their transforms instead of being registered again. Pairs of files
+    whose outputs were all written are skipped without being loaded.
+    """
+    def __init__(self, elastix, pairs, registration_steps, update_progress, max_running=1, cores=None, memory_limit=None, output_directory=None,
+                 pair_changed=lambda pair: None, journal=None):
+        self.elastix = elastix
+        ## The largest jobs are also the longest, and starting them first keeps one from running alone at the end
+        self.pending = sorted([BatchJob(pair, list(registration_steps)) for pair in pairs], key=lambda job: job.estimatedMemory, reverse=True)
+        self.running = []
+        self.finished = []
+        self.total = len(self.pending)
+        self.updateProgress = update_progress
+        self.pairChanged = pair_changed
+        self.maxRunning = max(1, max_running)
+        self.memoryLimit = memory_limit
+        self.outputDirectory = output_directory
+        self.journal = journal
+        self.threads = max(1, (cores or os.cpu_count() or 1) // self.maxRunning)
+        self.lastText = None
+        self.timer = qt.QTimer()
+        self.timer.setInterval(100)
+        self.timer.connect('timeout()', self.tick)
+
+    def start(self):
+        self.timer.start()
+
+    def is_done(self):
+        return not self.pending and not self.running
+
+    def tick(self):
+        for job in list(self.pending):
+            if len(self.running) >= self.maxRunning: break
+            if not self.can_admit(job): continue
+            self.pending.remove(job)
+            self.running.append(job)
+            try:
+                self.start_job(job)
+            except Exception as e:
+                traceback.print_exc()
+                self.fail_job(job, e)
+        for job in list(self.running):
+            try:
+                self.poll_job(job)
+            except Exception as e:
+                traceback.print_exc()
+                self.fail_job(job, e)
+        if self.running:
+            job = self.running[-1]
+            text = job.text if job.text != self.lastText else None
+            self.lastText = job.text
+            self.updateProgress(text=text, current_registration_step=job.current_step(), progress=self.get_progress())
+        if self.is_done():
+            self.timer.stop()
+            self.updateProgress(progress=100, immediate=True)
+
+    def can_admit(self, job):
+        if not self.running or self.memoryLimit is None: return True
+        return sum(j.estimatedMemory for j in self.running) + job.estimatedMemory <= self.memoryLimit
+
+    def get_progress(self):
+        done = len(self.finished) + sum(job.progress() for job in self.running)
+        return min(99, int(100*done/max(1, self.total)))
+
+    def start_job(self, job):
+        job.pair.status = PairStatus.EXECUTING
+        self.pairChanged(job.pair)
+        if self.journal is not None and job.pair.is_file_pair():
+            job.key = IntraSampleRegistrationLogic.get_pair_key(job.pair)
+            if self.journal.get_outputs(job.key, job.stepKeys) is not None:
+                logging.info("Skipping %s, which the batch journal has as complete" % os.path.basename(job.pair.movingPath))
+                job.stepIndex = len(job.steps)
+                return self.finish_job(job, PairStatus.COMPLETE)
+        if job.pair.is_file_pair():
+            for path in (job.pair.fixedPath, job.pair.movingPath):
+                node = slicer.util.loadVolume(path, {'show': False})
+                if not node: raise RuntimeError("Could not load " + path)
+                job.loadedNodes.append(node)
+            job.fixedNode, job.movingNode = job.loadedNodes
+        else:
+            job.fixedNode, job.movingNode = job.pair.fixed.currentNode(), job.pair.moving.currentNode()
+        ## The output shares the moving volume's voxels; only its geometry changes
+        job.outputNode = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(job.movingNode, name=job.movingNode.GetName())
+        job.outputNode.HideFromEditorsOff()
+        if self.journal is not None:
+            if job.key is None: job.key = IntraSampleRegistrationLogic.get_pair_key(job.pair)
+            for step in self.journal.get_completed_steps(job.key, job.stepKeys):
+                transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", job.outputNode.GetName() + step['suffix'] + " transform")
+                transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(np.array(step['matrix'])))
+                ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.append_transform(job.outputNode, transformNode)
+                job.transformNodes.append(transformNode)
+                job.suffix += step['suffix']
+                job.stepIndex += 1
+            if job.stepIndex: logging.info("Resuming %s after %d step(s) from the batch journal" % (job.movingNode.GetName(), job.stepIndex))
+
+    def poll_job(self, job):
+        if job.worker is None and job.cliNode is None:
+            step = job.current_step()
+            if step is None: return self.complete_job(job)
+            job.stepProgress = 0
+            if step.type is RegistrationType.CUSTOM_ELASTIX:
+                logic = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic
+                job.worker = logic.start_elastix_rigid_registration(self.elastix, job.fixedNode, job.outputNode, None,
+                                                                    parameter_filenames=(logic.get_registration_tier_parameter_file(step.tier()),),
+                                                                    threads=self.threads)
+            elif step.type is RegistrationType.CUSTOM_BRAINS:
+                job.cliNode, transformNode, job.referenceNode = IntraSampleRegistrationLogic.start_brains_rigid_registration(job.fixedNode, job.outputNode)
+                job.transformNodes.append(transformNode)
+            return
+        if job.worker is not None:
+            while not job.worker.log.empty():
+                job.text = job.worker.log.get_nowait()
+                progress = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.process_rigid_progress(job.text)
+                if progress is not None: job.stepProgress = max(job.stepProgress, progress)
+            if job.worker.is_alive(): return
+            worker, job.worker = job.worker, None
+            if worker.peakMemory is not None:
+                job.pair.peakMemory = max(job.pair.peakMemory or 0, worker.peakMemory)
+                self.pairChanged(job.pair)
+            transformNode = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.finish_elastix_rigid_registration(self.elastix, worker, job.outputNode.GetName())
+            job.transformNodes.append(transformNode)
+            suffix = '_Elastix'
+        else:
+            if job.cliNode.IsBusy():
+                job.text = job.cliNode.GetStatusString()
+                return
+            cliNode, job.cliNode = job.cliNode, None
+            slicer.mrmlScene.RemoveNode(job.referenceNode)
+            job.referenceNode = None
+            if cliNode.GetStatus() != cliNode.Completed: raise RuntimeError("BRAINSFit " + cliNode.GetStatusString() + ": " + cliNode.GetErrorText())
+            slicer.mrmlScene.RemoveNode(cliNode)
+            suffix = '_BRAINS'
+            transformNode = job.transformNodes[-1]
+        logging.debug("Transform generated: %s" % transformNode.GetID())
+        job.suffix += suffix
+        ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.append_transform(job.outputNode, transformNode)
+        if self.journal is not None:
+            toParent = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformToParent(toParent)
+            self.journal.record_step(job.key, job.stepIndex, job.stepKeys[job.stepIndex], slicer.util.arrayFromVTKMatrix(toParent), suffix)
+        job.stepIndex += 1
+        job.stepProgress = 0
+
+    def complete_job(self, job):
+        name = job.movingNode.GetName() + job.suffix
+        outputDirectory = self.outputDirectory
+        if outputDirectory is None and job.pair.is_file_pair(): outputDirectory = os.path.dirname(job.pair.movingPath)
+        job.outputNode.SetName(name)
+        ## Every transform is linear, so hardening the chain only updates the output's geometry
+        outputs = []
+        if outputDirectory is not None: outputs = IntraSampleRegistrationLogic.save_registration_result(job.outputNode, name, outputDirectory)
+        else: job.outputNode.HardenTransform()
+        if self.journal is not None: self.journal.record_status(job.key, 'complete', outputs)
+        if job.pair.is_file_pair():
+            self.cleanup_job(job)
+        else:
+            job.pair.moving.setCurrentNode(job.outputNode)
+        self.finish_job(job, PairStatus.COMPLETE)
+
+    def fail_job(self, job, error):
+        job.text = "Error: " + str(error)
+        self.cleanup_job(job)
+        if self.journal is not None and job.key is not None:
+            try:
+                self.journal.record_status(job.key, 'failed', error=str(error))
+            except OSError:
+                traceback.print_exc()
+        self.finish_job(job, PairStatus.FAILED)
+
+    def finish_job(self, job, status):
+        job.pair.status = status
+        self.pairChanged(job.pair)
+        if job in self.running: self.running.remove(job)
+        self.finished.append(job)
+
+    def cleanup_job(self, job):
+        if job.worker is not None:
+            job.worker.abort()
+            if job.worker.tempDir is not None: shutil.rmtree(job.worker.tempDir, ignore_errors=True)
+        if job.cliNode is not None:
+            job.cliNode.Cancel()
+        resampleCache = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.resampleCache
+        for node in [job.referenceNode, job.outputNode] + job.transformNodes + job.loadedNodes:
+            if node is None: continue
+            ## The cached content hashes hold on to their nodes, and with them to the voxels
+            resampleCache.invalidate(node.GetID())
+            slicer.mrmlScene.RemoveNode(node)
+        job.worker = job.cliNode = job.referenceNode = job.outputNode = job.fixedNode = job.movingNode = None
+        job.transformNodes = []
+        job.loadedNodes = []
+
+    def cancel(self):
+        self.timer.stop()
+        for job in list(self.running): self.fail_job(job, ValueError("User requested cancel."))
+        for job in self.pending:
+            job.pair.status = PairStatus.FAILED
+            self.pairChanged(job.pair)
+        self.pending = []
+
+
 class IntraSampleRegistrationLogic(ScriptedLoadableModuleLogic):
+    brainsParameters = {
+        'transformType': 'Rigid',
+        'samplingPercentage'    : 0.01,
+        'initialTransformMode'  : 'off',
+        'maskProcessingMode'    : 'NOMASK',  # TODO double check Masking = NOMASK
+        'costMetric'            : 'NC',
+        'numberOfIterations'    : 1000,   # TODO check if theres a max param
+        'minimumStepLength'	    : 0.0000001,
+        'maximumStepLength'     : 0.001,
+        'skewScale'             : 1.0,
+        'reproportionScale'     : 1.0,
+        'relaxationFactor'      : 0.5,
+        'translationScale'      : 1.0  # aka transform scale
+    }
+    defaultPairPattern = r"^(.+?)\.(?:nrrd|nhdr|nii|nii\.gz|mha|mhd)$"
+
+    @staticmethod
+    def execute_batch(elastix, pairs, registration_steps, update_progress, max_running=1):
+        """Run a batch to completion without returning to the event loop."""
+        scheduler = BatchScheduler(elastix, pairs, registration_steps, update_progress, max_running)
+        while not scheduler.is_done():
+            scheduler.tick()
+            ## CLI nodes only update their status from the event loop
+            slicer.app.processEvents()
+            time.sleep(0.1)
+        return scheduler
+
+    @staticmethod
+    def estimate_job_memory(pair, registration_steps):
+        """Estimate the peak memory of a pair's registrations, which run one after the other."""
+        logic = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic
+        estimates = [0]
+        for step in registration_steps:
+            ## BRAINSFit also works on float images with a downsampling pyramid
+            parameterFilenames = (logic.get_registration_tier_parameter_file(step.tier()),) if step.type is RegistrationType.CUSTOM_ELASTIX else ()
+            estimates.append(logic.estimate_registration_memory(pair.fixed_source(), pair.moving_source(), parameterFilenames))
+        return max(estimates)
+
+    @staticmethod
+    def get_step_key(step):
+        """Identify a step for the batch journal by what determines its result, so that changed parameters
+        are not replayed from an older run."""
+        if step.type is RegistrationType.CUSTOM_ELASTIX:
+            filename = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.get_registration_tier_parameter_file(step.tier())
+            parametersDir = os.path.join(os.path.dirname(os.path.abspath(ABLTemporalBoneSegmentationModule.__file__)), 'Resources', 'Parameters')
+            with open(os.path.join(parametersDir, filename), 'rb') as f: digest = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+            return 'elastix:' + step.tier() + ':' + digest
+        return 'brains:' + hashlib.blake2b(repr(sorted(IntraSampleRegistrationLogic.brainsParameters.items())).encode(), digest_size=8).hexdigest()
+
+    @staticmethod
+    def get_pair_key(pair):
+        """Identify a pair for the batch journal: files by path, size and modification time, and scene
+        volumes by their voxels and world geometry."""
+        h = hashlib.blake2b(digest_size=16)
+        if pair.is_file_pair():
+            for path in (pair.fixedPath, pair.movingPath):
+                stat = os.stat(path)
+                h.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode())
+        else:
+            logic = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic
+            for node in (pair.fixed.currentNode(), pair.moving.currentNode()):
+                h.update(logic.resampleCache.get_content_hash(node).encode())
+                h.update(logic.get_world_ijk_to_ras(node).round(9).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def get_journal_path(output_directory=None):
+        """The batch journal goes with the outputs, or in the registration cache when there are none."""
+        if output_directory: return os.path.join(output_directory, 'batch_journal.json')
+        return os.path.join(ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.get_registration_cache_dir('batches'), 'journal.json')
+
+    @staticmethod
+    def match_directory_pairs(fixed_directory, moving_directory, pattern):
+        """Pair the files of two directories whose names give the same key for ``pattern``.
+
+        The key is the pattern's first group, or the whole match if it has none. Files that do not match,
+        or whose key is only found in one directory, are left out.
+
+        :return: A list of (fixed path, moving path), sorted by key.
+        """
+        pattern = re.compile(pattern)
+        def keyed_files(directory):
+            files = {}
+            for name in sorted(os.listdir(directory)):
+                match = pattern.search(name)
+                if match is None or not os.path.isfile(os.path.join(directory, name)): continue
+                key = match.group(1) if pattern.groups else match.group(0)
+                if key in files: logging.warning("Ignoring %s, which has the same key as %s" % (name, os.path.basename(files[key])))
+                else: files[key] = os.path.join(directory, name)
+            return files
+        fixedFiles, movingFiles = keyed_files(fixed_directory), keyed_files(moving_directory)
+        return [(fixedFiles[key], movingFiles[key]) for key in sorted(fixedFiles.keys() & movingFiles.keys())]
+
+    @staticmethod
+    def read_pair_manifest(path):
+        """Read the pairs of a CSV file with 'fixed' and 'moving' columns. Relative paths start at the CSV's directory."""
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, newline='') as f:
+            return [(os.path.join(directory, row['fixed'].strip()), os.path.join(directory, row['moving'].strip()))
+                    for row in csv.DictReader(f) if row['fixed'] and row['moving']]
+
     @staticmethod
-    def execute_batch(elastix, pairs, registration_steps, update_progress):
-        for pair in pairs:
-            pair.status = PairStatus.EXECUTING
-            outputNode = pair.moving.currentNode()
-            for registration in registration_steps:
-                update_progress(current_registration_step=registration)
-                if registration is RegistrationType.CUSTOM_ELASTIX:
-                    outputNode = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.apply_elastix_rigid_registration(
-                        elastix=elastix,
-                        atlas_node=pair.fixed.currentNode(),
-                        moving_node=outputNode,
-                        mask_node=None,
-                        log_callback=update_progress
-                    )
-                    update_progress(progress=100)
-                elif registration is RegistrationType.CUSTOM_BRAINS:
-                    outputNode = IntraSampleRegistrationLogic.apply_brains_rigid_registration(
-                        pair=pair,
-                        moving_node=outputNode,
-                        log_callback=update_progress
-                    )
-                    update_progress(progress=100)
-            pair.moving.setCurrentNode(outputNode)
-            pair.status = PairStatus.COMPLETE
-            update_progress()
+    def save_registration_result(node, name, output_directory):
+        """Harden the transforms of a moved volume and write it, along with the composition of those transforms.
+
+        The transform is written as ``<name>_transform.h5`` and maps the moving volume to the fixed one.
+
+        :return: The paths of the written volume and transform.
+        """
+        os.makedirs(output_directory, exist_ok=True)
+        toWorld = vtk.vtkMatrix4x4()
+        if node.GetParentTransformNode() is not None: node.GetParentTransformNode().GetMatrixTransformToWorld(toWorld)
+        transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name + " transform")
+        transformPath = os.path.join(output_directory, name + "_transform.h5")
+        try:
+            transformNode.SetMatrixTransformToParent(toWorld)
+            if not slicer.util.saveNode(transformNode, transformPath):
+                raise RuntimeError("Could not write the transform of " + name)
+        finally:
+            slicer.mrmlScene.RemoveNode(transformNode)
+        node.HardenTransform()
+        volumePath = os.path.join(output_directory, name + ".nrrd")
+        if not slicer.util.saveNode(node, volumePath):
+            raise RuntimeError("Could not write " + name)
+        return [volumePath, transformPath]
 
     @staticmethod
-    def apply_brains_rigid_registration(moving_node, pair, log_callback):
+    def get_physical_memory():
+        try:
+            return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return 16*2**30
+
+    @staticmethod
+    def start_brains_rigid_registration(fixed_node, moving_node):
+        """Start BRAINSFit in the background on the moving volume as seen through its transforms.
+
+        :return: The CLI node, the output transform node and the reference volume given to BRAINSFit,
+            to be removed once it finishes.
+        """
+        ## CLI modules ignore parent transforms, so BRAINSFit gets a volume with them folded into its geometry
+        reference_node = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.create_world_reference_volume(moving_node)
         transform_node = slicer.vtkMRMLTransformNode()
         transform_node.SetName(moving_node.GetName() + ' BRAINS transform')
         slicer.mrmlScene.AddNode(transform_node)
-        # TODO use runSync
-        slicer.cli.run(slicer.modules.brainsfit, None, {
-            'fixedVolume': pair.fixed.currentNode().GetID(),
-            'movingVolume': moving_node.GetID(),
-            'outputTransform': transform_node.GetID(),
-            'transformType': 'Rigid',
-            'samplingPercentage'    : 0.01,
-            'initialTransformMode'  : 'off',
-            'maskProcessingMode'    : 'NOMASK',  # TODO double check Masking = NOMASK
-            'costMetric'            : 'NC',
-            'numberOfIterations'    : 1000,   # TODO check if theres a max param
-            'minimumStepLength'	    : 0.0000001,
-            'maximumStepLength'     : 0.001,
-            'skewScale'             : 1.0,
-            'reproportionScale'     : 1.0,
-            'relaxationFactor'      : 0.5,
-            'translationScale'      : 1.0  # aka transform scale
-        }, wait_for_completion=True)
-        print('TRANSFORM GENERATED: '); print(transform_node)
-        moving_node.ApplyTransform(transform_node.GetTransformToParent())
-        moving_node.HardenTransform()
-        moving_node.SetName(moving_node.GetName() + "_BRAINS")
-        return moving_node
+        parameters = dict(IntraSampleRegistrationLogic.brainsParameters, fixedVolume=fixed_node.GetID(), movingVolume=reference_node.GetID(), outputTransform=transform_node.GetID())
+        cli_node = slicer.cli.run(slicer.modules.brainsfit, None, parameters, wait_for_completion=False)
+        return cli_node, transform_node, reference_node
 
 
 class IntraSampleRegistrationTest(ScriptedLoadableModuleTest):
@@ -448,3 +1051,6 @@ class IntraSampleRegistrationTest(ScriptedLoadableModuleTest):
 
     def test_IntraSampleRegistration1(self):
         self.delayDisplay("Starting the test")
+
+
+logging.debug("IntraSampleRegistration imported in %.1f ms" % ((time.perf_counter() - importStartTime)*1000))